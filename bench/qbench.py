@@ -0,0 +1,290 @@
+#!/usr/bin/env python
+"""Benchmark gitq end to end against throwaway synthetic repositories.
+
+Builds a repo with a configurable number of files, commits of history and
+extra refs, then drives a queue through qnew, qrefresh, qpop, qpush, qdiff,
+qpatch and qcommit, timing every invocation. For each command we record wall
+time, how many git processes it started (counted with GIT_TRACE2_EVENT) and
+the peak RSS of the biggest single process in its tree. Results are written
+as JSON so runs from different releases can be compared with --compare.
+"""
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+GITQ_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+COMMANDS = ['qnew', 'qrefresh', 'qpush', 'qpop', 'qpatch', 'qcommit', 'qdiff',
+            'qgoto']
+
+class Bench(object):
+    def __init__(self, args):
+        self.args = args
+        self.tmp = tempfile.mkdtemp(prefix='qbench.')
+        self.repo = os.path.join(self.tmp, 'repo')
+        self.bindir = os.path.join(self.tmp, 'bin')
+        self.tracefile = os.path.join(self.tmp, 'trace2')
+        self.samples = []
+
+        self.env = dict(os.environ)
+        self.env['PATH'] = os.pathsep.join([self.bindir, self.env['PATH']])
+        pypath = [GITQ_DIR]
+        if self.env.get('PYTHONPATH'):
+            pypath.append(self.env['PYTHONPATH'])
+        self.env['PYTHONPATH'] = os.pathsep.join(pypath)
+        for who in ('AUTHOR', 'COMMITTER'):
+            self.env['GIT_%s_NAME' % (who,)] = 'qbench'
+            self.env['GIT_%s_EMAIL' % (who,)] = 'qbench@example.com'
+        self.env.pop('GITQ_TRACE', None)
+        self.env.pop('GITQ_PROFILE', None)
+
+    def cleanup(self):
+        if not self.args.keep:
+            shutil.rmtree(self.tmp)
+        else:
+            sys.stderr.write('Left benchmark repository in %s\n' % (self.tmp,))
+
+    def git(self, args, input=None):
+        """Run git for setup work, which isn't measured
+        """
+        stdin = subprocess.PIPE if input is not None else None
+        proc = subprocess.Popen(['git'] + args, cwd=self.repo, env=self.env,
+            stdin=stdin, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        out, err = proc.communicate(input)
+        if proc.returncode:
+            sys.stderr.write(err)
+            raise SystemExit('git %s failed' % (' '.join(args),))
+        return out
+
+    def install(self):
+        """Point git-q* at this checkout of gitq, laid out the way make
+        install does it
+        """
+        os.mkdir(self.bindir)
+        os.symlink(os.path.join(GITQ_DIR, 'qdispatch.py'),
+                   os.path.join(self.bindir, 'git-q'))
+        for script in os.listdir(GITQ_DIR):
+            if script.startswith('q') and script.endswith('.py') and \
+               script != 'qdispatch.py':
+                os.symlink('git-q',
+                           os.path.join(self.bindir, 'git-%s' % (script[:-3],)))
+
+    def build_repo(self):
+        """Make the synthetic repository with fast-import, which is quick
+        enough to make very large trees
+        """
+        a = self.args
+        os.mkdir(self.repo)
+        self.git(['init', '-q'])
+        self.git(['config', 'core.autocrlf', 'false'])
+
+        stream = []
+        mark = 0
+        def blob(data):
+            stream.append('blob\nmark :%d\ndata %d\n%s\n' %
+                          (mark, len(data), data))
+        paths = ['d%03d/f%06d.txt' % (i % 100, i) for i in range(a.files)]
+        ts = 1000000000
+        for depth in range(a.depth):
+            if depth == 0:
+                changed = range(a.files)
+            else:
+                changed = [depth % a.files]
+            marks = []
+            for i in changed:
+                mark += 1
+                blob('file %d rev %d\n%s' % (i, depth, 'x' * 64 + '\n') * 8)
+                marks.append((mark, paths[i]))
+            msg = 'commit %d' % (depth,)
+            stream.append('commit refs/heads/master\n'
+                          'committer qbench <qbench@example.com> %d +0000\n'
+                          'data %d\n%s\n' % (ts + depth, len(msg), msg))
+            for m, path in marks:
+                stream.append('M 100644 :%d %s\n' % (m, path))
+            stream.append('\n')
+        self.git(['fast-import', '--quiet'], input=''.join(stream))
+
+        if a.refs:
+            head = self.git(['rev-parse', 'master']).strip()
+            refs = ''.join('create refs/tags/bench-%d %s\n' % (i, head)
+                           for i in range(a.refs))
+            self.git(['update-ref', '--stdin'], input=refs)
+
+        self.git(['checkout', '-q', '-f', 'master'])
+        self.git(['branch', 'bench-target'])
+        self.paths = paths
+
+    def run(self, command, args):
+        """Run one gitq command and record how it did
+        """
+        if os.path.exists(self.tracefile):
+            os.unlink(self.tracefile)
+        env = dict(self.env)
+        env['GIT_TRACE2_EVENT'] = self.tracefile
+
+        devnull = file(os.devnull, 'w')
+        # stderr goes to a file, not a pipe, so a chatty command can't block
+        # on it while we sit in wait4
+        errfile = tempfile.TemporaryFile(dir=self.tmp)
+        start = time.time()
+        proc = subprocess.Popen(['git', command] + args, cwd=self.repo,
+            env=env, stdin=devnull, stdout=devnull, stderr=errfile)
+        # wait4 covers the whole tree below the command, which is where all
+        # the git processes live. ru_maxrss is the largest of them, not
+        # their sum.
+        _, status, usage = os.wait4(proc.pid, 0)
+        wall = time.time() - start
+        errfile.seek(0)
+        err = errfile.read()
+        errfile.close()
+        devnull.close()
+
+        if status:
+            sys.stderr.write(err)
+            raise SystemExit('git %s %s failed' % (command, ' '.join(args)))
+
+        starts = 0
+        if os.path.exists(self.tracefile):
+            with file(self.tracefile) as f:
+                starts = sum(1 for l in f if '"event":"start"' in l)
+
+        self.samples.append({'command': command, 'args': args,
+            'wall': wall, 'subprocesses': starts,
+            'max_rss_kb': usage.ru_maxrss})
+
+    def touch(self, n, round):
+        path = os.path.join(self.repo, self.paths[n % len(self.paths)])
+        with file(path, 'a') as f:
+            f.write('patch %d round %d\n' % (n, round))
+
+    def scenario(self):
+        a = self.args
+        for p in range(a.patches):
+            self.touch(p, 0)
+            self.run('qnew', ['-a', '-m', 'bench patch %d' % (p,),
+                              'bench-%d' % (p,)])
+            for r in range(a.fixups):
+                self.touch(p, r + 1)
+                self.run('qrefresh', ['-a'])
+
+        for _ in range(a.runs):
+            self.run('qdiff', [])
+            self.run('qpatch', ['-o', os.path.join(self.tmp, 'patches')])
+            shutil.rmtree(os.path.join(self.tmp, 'patches'))
+
+        for _ in range(a.runs):
+            for p in range(a.patches):
+                self.run('qpop', [])
+            for p in range(a.patches):
+                self.run('qpush', [])
+            self.run('qpop', ['--all'])
+            self.run('qpush', ['--all'])
+            self.run('qgoto', ['bench-0'])
+            self.run('qgoto', ['bench-%d' % (a.patches - 1,)])
+
+        self.run('qcommit', ['bench-target'])
+
+def summarize(samples):
+    results = {}
+    for cmd in COMMANDS:
+        runs = [s for s in samples if s['command'] == cmd]
+        if not runs:
+            continue
+        walls = sorted(s['wall'] for s in runs)
+        procs = sorted(s['subprocesses'] for s in runs)
+        results[cmd] = {
+            'runs': len(runs),
+            'wall': {'min': walls[0], 'max': walls[-1],
+                     'median': walls[len(walls) // 2],
+                     'mean': sum(walls) / len(walls)},
+            'subprocesses': {'min': procs[0], 'max': procs[-1],
+                             'median': procs[len(procs) // 2]},
+            'max_rss_kb': max(s['max_rss_kb'] for s in runs),
+        }
+    return results
+
+def describe():
+    proc = subprocess.Popen(['git', 'describe', '--always', '--dirty'],
+        cwd=GITQ_DIR, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    out = proc.communicate()[0].strip()
+    proc = subprocess.Popen(['git', 'version'], stdout=subprocess.PIPE)
+    git = proc.communicate()[0].strip()
+    return out or None, git
+
+def compare(old, new):
+    """Print how each command's median wall time moved between two runs
+    """
+    sys.stderr.write('%-10s %10s %10s %8s\n' % ('command', 'old', 'new',
+                                                'change'))
+    for cmd in COMMANDS:
+        if cmd not in old['results'] or cmd not in new['results']:
+            continue
+        o = old['results'][cmd]['wall']['median']
+        n = new['results'][cmd]['wall']['median']
+        sys.stderr.write('%-10s %9.3fs %9.3fs %+7.1f%%\n' %
+                         (cmd, o, n, (n - o) / o * 100 if o else 0))
+
+def main():
+    ap = argparse.ArgumentParser(description='Benchmark gitq commands',
+        prog='qbench')
+    ap.add_argument('--files', type=int, default=1000,
+        help='Files in the synthetic tree')
+    ap.add_argument('--depth', type=int, default=100,
+        help='Commits of history')
+    ap.add_argument('--refs', type=int, default=100,
+        help='Extra refs (tags) in the repository')
+    ap.add_argument('--patches', type=int, default=10,
+        help='Patches in the queue')
+    ap.add_argument('--fixups', type=int, default=5,
+        help='qrefresh runs per patch')
+    ap.add_argument('--runs', type=int, default=3,
+        help='Times to repeat the push/pop/export rounds')
+    ap.add_argument('-o', dest='output', default=None,
+        help='Write JSON results here instead of stdout')
+    ap.add_argument('--compare', default=None,
+        help='Earlier JSON results to compare against')
+    ap.add_argument('--keep', default=False, action='store_true',
+        help='Keep the synthetic repository around')
+    args = ap.parse_args()
+
+    bench = Bench(args)
+    try:
+        bench.install()
+        bench.build_repo()
+        bench.scenario()
+    finally:
+        bench.cleanup()
+
+    version, git = describe()
+    report = {
+        'gitq': version,
+        'git': git,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'params': dict((k, getattr(args, k)) for k in
+                       ('files', 'depth', 'refs', 'patches', 'fixups', 'runs')),
+        'results': summarize(bench.samples),
+        'samples': bench.samples,
+    }
+
+    out = json.dumps(report, indent=2, sort_keys=True) + '\n'
+    if args.output:
+        with file(args.output, 'w') as f:
+            f.write(out)
+    else:
+        sys.stdout.write(out)
+
+    if args.compare:
+        with file(args.compare) as f:
+            compare(json.load(f), report)
+
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
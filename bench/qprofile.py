@@ -0,0 +1,55 @@
+#!/usr/bin/env python
+"""Summarize a GITQ_PROFILE log.
+
+Every gitq command run with GITQ_PROFILE=<log> appends one JSON line to the
+log. This adds them up per command, showing how often each ran, how long it
+took in total and on average, and which phases and git subcommands the time
+went to.
+"""
+
+import argparse
+import json
+import sys
+
+def main():
+    ap = argparse.ArgumentParser(description='Summarize a gitq profile log',
+        prog='qprofile')
+    ap.add_argument('log', help='File GITQ_PROFILE pointed at')
+    ap.add_argument('--since', type=float, default=0,
+        help='Only count runs after this unix time')
+    args = ap.parse_args()
+
+    commands = {}
+    with file(args.log) as f:
+        for line in f:
+            try:
+                run = json.loads(line)
+            except ValueError:
+                continue
+            if run['time'] < args.since:
+                continue
+            cmd = commands.setdefault(run['command'],
+                {'count': 0, 'wall': 0.0, 'git': {}, 'phases': {}})
+            cmd['count'] += 1
+            cmd['wall'] += run['wall']
+            for sub, stats in run['git'].items():
+                g = cmd['git'].setdefault(sub, {'count': 0, 'wall': 0.0})
+                g['count'] += stats['count']
+                g['wall'] += stats['wall']
+            for phase, wall in run['phases'].items():
+                cmd['phases'][phase] = cmd['phases'].get(phase, 0.0) + wall
+
+    out = sys.stdout
+    for name, cmd in sorted(commands.items(), key=lambda c: -c[1]['wall']):
+        out.write('%s: %d runs, %.3fs total, %.3fs mean\n' %
+                  (name, cmd['count'], cmd['wall'], cmd['wall'] / cmd['count']))
+        for phase, wall in sorted(cmd['phases'].items(), key=lambda p: -p[1]):
+            out.write('    [%s] %.3fs\n' % (phase, wall))
+        for sub, g in sorted(cmd['git'].items(), key=lambda s: -s[1]['wall']):
+            out.write('    git %s: %d calls, %.3fs\n' %
+                      (sub, g['count'], g['wall']))
+
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
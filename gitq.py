@@ -1,10 +1,369 @@
-import copy
+import atexit
+import functools
 import os
 import subprocess
+import sys
+import threading
+import time
 
 import pgl
 
 __checked = False
+__session = None
+__tracer = None
+
+class Tracer(object):
+    """Records every git process we start and every phase we go through, with
+    how long each took. At exit it either prints a table to stderr or dumps
+    JSON to a file, and in profile mode appends a one-line summary of the
+    command to a log so runs can be aggregated later.
+    """
+    def __init__(self, target=None, profile=None):
+        self.target = target
+        self.profile = profile
+        self.start = time.time()
+        self.records = []
+        self._lock = threading.Lock()
+        atexit.register(self.finish)
+
+    def record(self, kind, name):
+        rec = {'kind': kind, 'name': name, 'start': time.time() - self.start,
+               'wall': None, 'rc': None, 'bytes': 0}
+        with self._lock:
+            self.records.append(rec)
+        return rec
+
+    def finish(self):
+        wall = time.time() - self.start
+        command = os.path.basename(sys.argv[0])
+        argv = sys.argv[1:]
+        if self.target:
+            if self.target in ('1', 'true', 'yes', 'table'):
+                self._table(command, wall)
+            else:
+                import json
+                with file(self.target, 'w') as f:
+                    json.dump({'command': command, 'argv': argv, 'wall': wall,
+                               'records': self.records}, f, indent=2)
+        if self.profile:
+            self._profile(command, argv, wall)
+
+    def _table(self, command, wall):
+        out = sys.stderr
+        out.write('gitq trace for %s (%.3fs total)\n' % (command, wall))
+        out.write('%9s %4s %10s  %s\n' % ('wall', 'rc', 'bytes', 'what'))
+        for rec in self.records:
+            name = rec['name']
+            if rec['kind'] == 'git':
+                name = 'git %s' % (' '.join(name),)
+            else:
+                name = '[%s]' % (name,)
+            w = '-' if rec['wall'] is None else '%.4fs' % (rec['wall'],)
+            rc = '' if rec['rc'] is None else str(rec['rc'])
+            out.write('%9s %4s %10d  %s\n' % (w, rc, rec['bytes'], name))
+
+    def _profile(self, command, argv, wall):
+        import json
+        summary = {'time': self.start, 'command': command, 'argv': argv,
+                   'cwd': os.getcwd(), 'wall': wall, 'git': {},
+                   'phases': {}}
+        for rec in self.records:
+            if rec['kind'] == 'git':
+                subcommands = [a for a in rec['name'] if not a.startswith('-')]
+                key = subcommands[0] if subcommands else ''
+                bucket = summary['git'].setdefault(key,
+                    {'count': 0, 'wall': 0.0, 'bytes': 0})
+                bucket['count'] += 1
+                bucket['wall'] += rec['wall'] or 0.0
+                bucket['bytes'] += rec['bytes']
+            else:
+                summary['phases'][rec['name']] = \
+                    summary['phases'].get(rec['name'], 0.0) + (rec['wall'] or 0)
+        with file(self.profile, 'a') as f:
+            f.write(json.dumps(summary) + '\n')
+
+def tracer():
+    """Return the active tracer, starting one if GITQ_TRACE or GITQ_PROFILE
+    is set in the environment. Returns None if tracing is off.
+    """
+    global __tracer
+    if __tracer is None:
+        target = os.environ.get('GITQ_TRACE')
+        if target is not None and \
+           target.lower() in ('', '0', 'false', 'no', 'off'):
+            target = None
+        profile = os.environ.get('GITQ_PROFILE')
+        if target or profile:
+            __tracer = Tracer(target, profile)
+    return __tracer
+
+def start_trace(target):
+    """Turn on tracing, writing to target when we exit
+    """
+    global __tracer
+    t = tracer()
+    if t is None:
+        __tracer = Tracer(target)
+    else:
+        t.target = target
+
+def traced(name):
+    """Decorator that records a function as a phase when tracing is on
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            t = tracer()
+            if t is None:
+                return func(*args, **kwargs)
+            rec = t.record('phase', name)
+            began = time.time()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                rec['wall'] = time.time() - began
+        return wrapper
+    return decorator
+
+def parse_args(ap):
+    """Add the options every command takes, parse the command line and act
+    on them
+    """
+    ap.add_argument('--trace', dest='trace', nargs='?', const='table',
+        default=None, metavar='FILE',
+        help='Time every git call (to stderr, or as JSON to FILE)')
+    args = ap.parse_args()
+    if args.trace:
+        start_trace(args.trace)
+    return args
+
+class _CountingFile(object):
+    """Wraps a pipe from git and counts the bytes read out of it
+    """
+    def __init__(self, f, rec):
+        self._f = f
+        self._rec = rec
+
+    def read(self, *args):
+        data = self._f.read(*args)
+        self._rec['bytes'] += len(data)
+        return data
+
+    def readline(self, *args):
+        data = self._f.readline(*args)
+        self._rec['bytes'] += len(data)
+        return data
+
+    def readlines(self, *args):
+        lines = self._f.readlines(*args)
+        self._rec['bytes'] += sum(len(l) for l in lines)
+        return lines
+
+    def __iter__(self):
+        for line in self._f:
+            self._rec['bytes'] += len(line)
+            yield line
+
+    def __getattr__(self, attr):
+        return getattr(self._f, attr)
+
+class _TracedPopen(subprocess.Popen):
+    """Popen that reports its runtime, exit status and output size
+    """
+    def __init__(self, args, **kwargs):
+        self._rec = tracer().record('git', args[1:])
+        self._began = time.time()
+        subprocess.Popen.__init__(self, args, **kwargs)
+        if self.stdout is not None:
+            self.stdout = _CountingFile(self.stdout, self._rec)
+
+    def wait(self, *args, **kwargs):
+        rval = subprocess.Popen.wait(self, *args, **kwargs)
+        if self._rec['wall'] is None:
+            self._rec['wall'] = time.time() - self._began
+            self._rec['rc'] = rval
+        return rval
+
+    def communicate(self, *args, **kwargs):
+        out, err = subprocess.Popen.communicate(self, *args, **kwargs)
+        self.wait()
+        self._rec['bytes'] = len(out or '')
+        return out, err
+
+class GitSession(object):
+    """A long-lived connection to git. Object questions (what does this rev
+    point to, what type is this object, what's in this commit) are answered
+    over persistent cat-file processes, so we only pay for fork/exec and repo
+    discovery once per command instead of once per question. Everything else
+    goes through popen/run/call so there's exactly one place we start git.
+    """
+    def __init__(self, env=None):
+        self.env = env
+        self._check = None
+        self._batch = None
+        self._lock = threading.Lock()
+
+    def _cat_file(self, mode):
+        devnull = file(os.devnull, 'w')
+        proc = self.popen(['cat-file', mode], stdin=subprocess.PIPE,
+            stderr=devnull)
+        devnull.close()
+        return proc
+
+    def popen(self, args, **kwargs):
+        """Start git with the given arguments, returning the Popen object.
+        stdout and stderr default to pipes, like every caller wants.
+        """
+        kwargs.setdefault('stdout', subprocess.PIPE)
+        kwargs.setdefault('stderr', subprocess.PIPE)
+        if 'env' not in kwargs and self.env is not None:
+            kwargs['env'] = self.env
+        if tracer() is not None:
+            return _TracedPopen(['git'] + list(args), **kwargs)
+        return subprocess.Popen(['git'] + list(args), **kwargs)
+
+    def run(self, args, input=None, env=None):
+        """Run git to completion, returning (exit status, stdout)
+        """
+        stdin = None
+        if input is not None:
+            stdin = subprocess.PIPE
+        proc = self.popen(args, stdin=stdin, env=env or self.env)
+        out, _ = proc.communicate(input)
+        return proc.returncode, out
+
+    def call(self, args, env=None):
+        """Run git with our stdout and stderr, returning its exit status
+        """
+        proc = self.popen(args, stdout=None, stderr=None, env=env or self.env)
+        return proc.wait()
+
+    def lines(self, args, env=None):
+        """Run git and return its output as a list of stripped lines, or None
+        if it failed
+        """
+        rval, out = self.run(args, env=env)
+        if rval:
+            return None
+        return [l.strip() for l in out.splitlines()]
+
+    def object_info(self, rev):
+        """Return (sha, type, size) for rev, or None if it doesn't resolve
+        """
+        with self._lock:
+            if self._check is None:
+                self._check = self._cat_file('--batch-check')
+            self._check.stdin.write('%s\n' % (rev,))
+            self._check.stdin.flush()
+            line = self._check.stdout.readline()
+        if not line:
+            pgl.die('Lost connection to git cat-file')
+        bits = line.split()
+        if len(bits) != 3:
+            return None
+        return bits[0], bits[1], int(bits[2])
+
+    def rev_parse(self, rev):
+        """Resolve rev to a full sha, or None if it doesn't exist
+        """
+        info = self.object_info(rev)
+        if info is None:
+            return None
+        return info[0]
+
+    def object_type(self, rev):
+        """Return the type of the object rev names, or None
+        """
+        info = self.object_info(rev)
+        if info is None:
+            return None
+        return info[1]
+
+    def read_object(self, rev):
+        """Return (sha, type, contents) for rev, or None if it doesn't resolve
+        """
+        with self._lock:
+            if self._batch is None:
+                self._batch = self._cat_file('--batch')
+            self._batch.stdin.write('%s\n' % (rev,))
+            self._batch.stdin.flush()
+            line = self._batch.stdout.readline()
+            bits = line.split()
+            if len(bits) != 3:
+                if not line:
+                    pgl.die('Lost connection to git cat-file')
+                return None
+            size = int(bits[2])
+            data = self._batch.stdout.read(size)
+            self._batch.stdout.read(1) # Trailing newline
+        return bits[0], bits[1], data
+
+    def commit_info(self, rev):
+        """Parse the commit rev names into a dict with the sha, tree, parents,
+        author, committer and message. Returns None if rev isn't a commit.
+        """
+        obj = self.read_object('%s^{commit}' % (rev,))
+        if obj is None:
+            return None
+        sha, _, data = obj
+        header, _, message = data.partition('\n\n')
+        info = {'sha': sha, 'tree': None, 'parents': [], 'author': None,
+                'committer': None, 'message': message}
+        for line in header.split('\n'):
+            if line.startswith(' '):
+                # Continuation of a multi-line header (gpgsig, mergetag)
+                continue
+            key, _, val = line.partition(' ')
+            if key == 'parent':
+                info['parents'].append(val)
+            elif key in ('tree', 'author', 'committer'):
+                info[key] = val
+        return info
+
+    def subject(self, rev):
+        """Return the first line of the commit message for rev
+        """
+        info = self.commit_info(rev)
+        if info is None:
+            return None
+        return info['message'].split('\n', 1)[0].strip()
+
+    def close(self):
+        """Shut down our long-lived git processes
+        """
+        for proc in (self._check, self._batch):
+            if proc is not None:
+                proc.stdin.close()
+                proc.wait()
+        self._check = None
+        self._batch = None
+
+def session():
+    """Return the git session shared by everything in this process
+    """
+    global __session
+    if __session is None:
+        __session = GitSession()
+        atexit.register(__session.close)
+    return __session
+
+def split_ident(ident):
+    """Split an author/committer line from a commit into (name, email, date)
+    """
+    name, _, rest = ident.partition(' <')
+    email, _, date = rest.partition('> ')
+    return name, email, date
+
+def ident_env(ident, who='AUTHOR', env=None):
+    """Return a copy of env (or os.environ) with GIT_<who>_* set so git will
+    reuse the identity from a commit header
+    """
+    name, email, date = split_ident(ident)
+    genv = dict(env or os.environ)
+    genv['GIT_%s_NAME' % (who,)] = name
+    genv['GIT_%s_EMAIL' % (who,)] = email
+    genv['GIT_%s_DATE' % (who,)] = date
+    return genv
 
 def check():
     """Make sure we can do all the things we're going to want to do
@@ -14,89 +373,1047 @@ def check():
 
     __checked = True
 
+def _mtime(path):
+    try:
+        return repr(os.stat(path).st_mtime)
+    except OSError:
+        return '0'
+
+def resolve_branch(sha):
+    """Figure out which branch we're on by reading HEAD's symbolic ref
+    directly. If HEAD is detached, fall back to finding a branch containing
+    sha. That answer is cached under the queue directory, keyed on sha and
+    the modification times of packed-refs and the branch's own ref file, so
+    we don't go scanning refs when nothing has moved.
+    """
+    gitdir = pgl.config['GIT_DIR']
+    with file(os.path.join(gitdir, 'HEAD')) as f:
+        head = f.read().strip()
+    if head.startswith('ref: '):
+        ref = head[5:]
+        if ref.startswith('refs/heads/'):
+            return ref[11:]
+        return ref[5:]
+
+    cachefile = os.path.join(gitdir, 'queue', 'branch_cache')
+    def key(branch):
+        # The branch's loose ref changes when it moves, even if it's nested
+        # (topic/x) where the refs/heads directory wouldn't notice
+        return ' '.join([sha, _mtime(os.path.join(gitdir, 'packed-refs')),
+            _mtime(os.path.join(gitdir, 'refs', 'heads', branch))])
+
+    if os.path.exists(cachefile):
+        with file(cachefile) as f:
+            lines = f.read().split('\n')
+        if len(lines) >= 2 and lines[1] and lines[0] == key(lines[1]):
+            return lines[1]
+
+    # Detached HEAD, only look at branches so we don't walk every tag and
+    # remote ref in the repo
+    branch = None
+    lines = session().lines(['name-rev', '--name-only', '--no-undefined',
+                             '--refs=refs/heads/*', sha])
+    if lines:
+        branch = lines[0].split('~', 1)[0].split('^', 1)[0]
+
+    if branch is None:
+        return None
+
+    if not os.path.exists(os.path.dirname(cachefile)):
+        os.mkdir(os.path.dirname(cachefile))
+    with file(cachefile, 'w') as f:
+        f.write('%s\n%s\n' % (key(branch), branch))
+
+    return branch
+
+@traced('include_config')
 def include_config():
     """Stick our gitq-specific config in the pgl config object
     """
     if not __checked:
         check()
 
-    grp = subprocess.Popen(['git', 'rev-parse', '--verify', 'HEAD'],
-        stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    sha = grp.stdout.readlines()[0].strip()
-    grp.wait()
+    gs = session()
+    branch = os.environ.get('GITQ_BRANCH')
+    if branch:
+        # Work on a branch without having it checked out, say in a bare clone
+        sha = gs.rev_parse('refs/heads/%s' % (branch,))
+        if sha is None:
+            pgl.die('Could not find branch %s' % (branch,))
+    else:
+        sha = gs.rev_parse('HEAD')
+        if sha is None:
+            pgl.die('Could not figure out HEAD')
+
+        branch = resolve_branch(sha)
+        if branch is None:
+            pgl.die('Could not figure out what branch we are on')
 
-    gnr = subprocess.Popen(['git', 'name-rev', '--name-only', sha],
-        stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    branch = gnr.stdout.readlines()[0].strip()
-    gnr.wait()
+    pgl.config['HEAD_SHA'] = sha
+    select_queue(branch)
 
+def select_queue(branch):
+    """Point the config at the queue for branch
+    """
     sanitized_branch = branch.replace('/', '_')
 
-    pgl.config['HEAD_SHA'] = sha
     pgl.config['BRANCH'] = branch
     pgl.config['QUEUES'] = os.path.join(pgl.config['GIT_DIR'], 'queue')
     pgl.config['BRANCH_QUEUE'] = os.path.join(pgl.config['QUEUES'],
         sanitized_branch)
-    pgl.config['QUEUE_SERIES'] = os.path.join(pgl.config['BRANCH_QUEUE'],
-        'series')
-    pgl.config['UNAPPLIED_PATCHES'] = os.path.join(pgl.config['BRANCH_QUEUE'],
-        'unapplied')
-    pgl.config['SHA_NAME_MAP'] = os.path.join(pgl.config['BRANCH_QUEUE'],
-        'shaname')
+    pgl.config['QUEUE_REFS'] = 'refs/queue/%s' % (sanitized_branch,)
+    store = pgl.config.get('QUEUE_STORE')
+    if store is not None and store.qdir != pgl.config['BRANCH_QUEUE']:
+        pgl.config['QUEUE_STORE'] = None
+    cache = pgl.config.get('PATCH_CACHE')
+    if cache is not None and cache.qdir != pgl.config['BRANCH_QUEUE']:
+        pgl.config['PATCH_CACHE'] = None
+    pack = pgl.config.get('PATCH_PACK')
+    if pack is not None and pack.qdir != pgl.config['BRANCH_QUEUE']:
+        pgl.config['PATCH_PACK'] = None
 
-def load_series():
-    """Read queue series info from the metadata file
+def valid_patch_name(name):
+    """Return True if name can be used as a patch name. Parked patches live
+    under refs/queue, so names have to make sensible ref components.
     """
-    pgl.config['ACTIVE_PATCH'] = None
-    pgl.config['SERIES'] = []
-    pgl.config['UNAPPLIED'] = []
-    pgl.config['NAMES'] = {}
-    pgl.config['SHAS'] = {}
+    if not name or name.startswith('.') or name.startswith('-'):
+        return False
+    if name.endswith('.') or name.endswith('.lock'):
+        return False
+    if '..' in name or '@{' in name:
+        return False
+    for c in name:
+        if ord(c) < 0x20 or c in ' ~^:?*[\\/\x7f':
+            return False
+    return True
 
-    with file(pgl.config['QUEUE_SERIES']) as f:
+def parked_ref(sanitized_branch, name):
+    """Return the ref a parked patch is kept under in the queue for
+    sanitized_branch. Older versions of gitq took any name, so names that
+    can't be ref components are hex encoded under a namespace of their own,
+    where they can't clash with a valid name.
+    """
+    if valid_patch_name(name):
+        return 'refs/queue/%s/%s' % (sanitized_branch, name)
+    return 'refs/queue-hex/%s/%s' % (sanitized_branch, name.encode('hex'))
+
+def patch_ref(name):
+    """Return the ref a parked patch is kept under
+    """
+    return parked_ref(os.path.basename(pgl.config['BRANCH_QUEUE']), name)
+
+def atomic_write(path, data):
+    """Write data to path such that readers see either the old contents or
+    the new contents, never a mix of the two
+    """
+    tmp = '%s.tmp.%d' % (path, os.getpid())
+    with file(tmp, 'w') as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.rename(tmp, path)
+
+class QueueStore(object):
+    """Versioned metadata for one branch queue: the applied series, the
+    unapplied patches and the sha -> name map.
+
+    The state lives in a snapshot file plus an append-only journal. Each
+    write_series appends one transaction to the journal describing only what
+    changed, terminated by a commit record, so pushing or popping one patch
+    costs a single small append no matter how long the queue is. A torn
+    transaction at the end of the journal (crash, ^C) has no commit record and
+    is ignored. Every so often the journal is folded into a fresh snapshot,
+    which is swapped in with write-then-rename.
+    """
+    VERSION = 1
+    COMPACT_AFTER = 128
+
+    def __init__(self, qdir, branch=None):
+        self.qdir = qdir
+        self.branch = branch
+        self.meta = os.path.join(qdir, 'meta')
+        self.journal = os.path.join(qdir, 'journal')
+        self._state = None
+        self._seq = 0
+        self._txns = 0
+        self._journal_len = 0
+
+    def create(self):
+        """Start an empty queue
+        """
+        self._state = self._empty()
+        self._seq = 0
+        self._compact()
+
+    def exists(self):
+        return os.path.exists(self.meta) or \
+               os.path.exists(os.path.join(self.qdir, 'series'))
+
+    @property
+    def state(self):
+        """The current queue state, loaded the first time anyone asks
+        """
+        if self._state is None:
+            self._load()
+        return self._state
+
+    @staticmethod
+    def _empty():
+        return {'series': [], 'unapplied': [], 'names': {}}
+
+    def _load(self):
+        self._state = self._empty()
+        self._seq = 0
+        self._txns = 0
+        self._journal_len = 0
+
+        if not os.path.exists(self.meta):
+            if os.path.exists(os.path.join(self.qdir, 'series')):
+                self._migrate(write=self.qdir in _exclusive_locks)
+            return
+
+        with file(self.meta) as f:
+            self._seq = self._parse_snapshot(f)
+
+        if not os.path.exists(self.journal):
+            return
+
+        pending = []
+        with file(self.journal) as f:
+            pos = 0
+            for line in f:
+                if not line.endswith('\n'):
+                    break # Torn write
+                pos += len(line)
+                line = line[:-1]
+                if line.startswith('C '):
+                    seq = int(line[2:])
+                    if seq > self._seq:
+                        for op in pending:
+                            self._apply(op)
+                        self._seq = seq
+                        self._txns += 1
+                    pending = []
+                    self._journal_len = pos
+                else:
+                    pending.append(line)
+
+    def _parse_snapshot(self, f):
+        state = self._state
+        seq = 0
+        magic = f.readline().split()
+        if len(magic) != 2 or magic[0] != 'gitq-queue':
+            pgl.die('Corrupt queue metadata in %s' % (self.meta,))
+        if int(magic[1]) > self.VERSION:
+            pgl.die('Queue metadata in %s is from a newer gitq' % (self.meta,))
         for line in f:
-            base = line.strip()
-            pgl.config['SERIES'].append(base)
+            tag, _, val = line.rstrip('\n').partition(' ')
+            if tag == 'seq':
+                seq = int(val)
+            elif tag == 'branch':
+                if self.branch is None:
+                    self.branch = val
+            elif tag == 'S':
+                state['series'].append(val)
+            elif tag == 'U':
+                state['unapplied'].append(val)
+            elif tag == 'N':
+                sha, name = val.split(' ', 1)
+                state['names'][sha] = name
+        return seq
+
+    def _migrate(self, write=True):
+        """Pull in the series/unapplied/shaname files older gitq wrote, and
+        replace them with a snapshot if write. Only a command holding the
+        queue lock exclusively gets to do that; readers just use them.
+        """
+        state = self._state
+        legacy = [os.path.join(self.qdir, n)
+                  for n in ('series', 'unapplied', 'shaname')]
+        for key, path in zip(('series', 'unapplied'), legacy):
+            if os.path.exists(path):
+                with file(path) as f:
+                    state[key] = [l.strip() for l in f if l.strip()]
+        if os.path.exists(legacy[2]):
+            with file(legacy[2]) as f:
+                for line in f:
+                    if line.strip():
+                        sha, name = line.strip().split(' ', 1)
+                        state['names'][sha] = name
+        if not write:
+            return
+        self._compact()
+        for path in legacy:
+            if os.path.exists(path):
+                os.unlink(path)
+
+    def _apply(self, op):
+        tag, _, val = op.partition(' ')
+        state = self._state
+        key = {'S': 'series', 'U': 'unapplied'}.get(tag[0])
+        if tag == 'N+':
+            sha, name = val.split(' ', 1)
+            state['names'][sha] = name
+        elif tag == 'N-':
+            state['names'].pop(val, None)
+        elif tag[1] == '+':
+            state[key].append(val)
+        elif tag[1] == '-':
+            if val in state[key]:
+                state[key].remove(val)
+        elif tag[1] == '0':
+            state[key] = []
+
+    @staticmethod
+    def _list_ops(tag, old, new):
+        newset = set(new)
+        kept = [x for x in old if x in newset]
+        ops = ['%s- %s' % (tag, x) for x in old if x not in newset]
+        if new[:len(kept)] == kept:
+            ops += ['%s+ %s' % (tag, x) for x in new[len(kept):]]
+        else:
+            # Reordered, just start over
+            ops = ['%s0' % (tag,)] + ['%s+ %s' % (tag, x) for x in new]
+        return ops
+
+    def diff(self, series, unapplied, names):
+        """Return the journal ops that turn our state into the given one
+        """
+        old = self.state
+        ops = self._list_ops('S', old['series'], series)
+        ops += self._list_ops('U', old['unapplied'], unapplied)
+        for sha in old['names']:
+            if sha not in names:
+                ops.append('N- %s' % (sha,))
+        for sha, name in names.iteritems():
+            if old['names'].get(sha) != name:
+                ops.append('N+ %s %s' % (sha, name))
+        return ops
+
+    def commit(self, series, unapplied, names):
+        """Atomically move the queue to the given state
+        """
+        ops = self.diff(series, unapplied, names)
+        if not ops:
+            return
+        for op in ops:
+            self._apply(op)
+        self._seq += 1
+        self._txns += 1
+
+        if self._txns >= self.COMPACT_AFTER or not os.path.exists(self.meta):
+            self._compact()
+            return
+
+        record = ''.join('%s\n' % (op,) for op in ops)
+        record += 'C %d\n' % (self._seq,)
+        with file(self.journal, 'a+') as f:
+            f.seek(0, os.SEEK_END)
+            if f.tell() != self._journal_len:
+                # Drop whatever a crashed writer left behind
+                f.truncate(self._journal_len)
+            f.write(record)
+            f.flush()
+            os.fsync(f.fileno())
+        self._journal_len += len(record)
+
+    def _compact(self):
+        """Fold the journal into a new snapshot
+        """
+        state = self._state
+        lines = ['gitq-queue %d' % (self.VERSION,), 'seq %d' % (self._seq,)]
+        if self.branch is not None:
+            lines.append('branch %s' % (self.branch,))
+        lines += ['S %s' % (sha,) for sha in state['series']]
+        lines += ['U %s' % (sha,) for sha in state['unapplied']]
+        lines += ['N %s %s' % (sha, name)
+                  for sha, name in state['names'].iteritems()]
+        atomic_write(self.meta, '\n'.join(lines) + '\n')
+        # Everything in the journal is now at or below the snapshot's seq, so
+        # it's safe to throw away even if we die before getting here
+        file(self.journal, 'w').close()
+        self._txns = 0
+        self._journal_len = 0
+
+def queue_store():
+    """Return the metadata store for the current branch queue
+    """
+    if pgl.config.get('QUEUE_STORE') is None:
+        pgl.config['QUEUE_STORE'] = QueueStore(pgl.config['BRANCH_QUEUE'],
+                                               pgl.config['BRANCH'])
+    return pgl.config['QUEUE_STORE']
+
+def queue_exists():
+    """Return True if there's a queue for the current branch
+    """
+    return queue_store().exists()
+
+def init_queue():
+    """Make sure the queue for the current branch exists on disk
+    """
+    if not os.path.exists(pgl.config['BRANCH_QUEUE']):
+        if not os.path.exists(pgl.config['QUEUES']):
+            os.mkdir(pgl.config['QUEUES'])
+        os.mkdir(pgl.config['BRANCH_QUEUE'])
+    store = queue_store()
+    if not store.exists():
+        store.create()
 
+# Queue directories this process holds the lock on exclusively
+_exclusive_locks = set()
+
+class QueueLock(object):
+    """A reader/writer lock on one branch queue. Commands that only look at
+    the queue share it, so any number of them can run at once; commands that
+    change it hold it alone. It's an flock on a file in the queue directory,
+    so the kernel drops it if we die. Whoever holds it exclusively writes
+    their pid, host and command into the file, so a waiter can say who it's
+    waiting for and notice when that process is gone (which means a child it
+    left running still has the lock).
+    """
+    def __init__(self, qdir):
+        self.qdir = qdir
+        self.path = os.path.join(qdir, 'lock')
+        self.fd = None
+        self.exclusive = False
+
+    def owner(self):
+        """Return (pid, host, command) from the lock file, or None
+        """
+        try:
+            with file(self.path) as f:
+                pid, host, command = f.read().split('\n')[:3]
+            return int(pid), host, command
+        except (IOError, ValueError):
+            return None
+
+    def _describe_owner(self):
+        import socket
+
+        owner = self.owner()
+        if owner is None:
+            return 'another gitq command'
+        pid, host, command = owner
+        desc = '%s (pid %d on %s)' % (command, pid, host)
+        if host == socket.gethostname():
+            try:
+                os.kill(pid, 0)
+            except OSError:
+                desc += ', which has exited. A process it started may still ' \
+                        'be running'
+        return desc
+
+    def acquire(self, exclusive=False, timeout=None):
+        """Take the lock, waiting up to timeout seconds (GITQ_LOCK_TIMEOUT,
+        30 by default) for other commands to finish
+        """
+        import fcntl
+
+        if self.fd is not None and (self.exclusive or not exclusive):
+            return
+        if not exclusive and not os.path.exists(self.qdir):
+            # No queue yet, so nothing to read
+            return
+        if timeout is None:
+            timeout = float(os.environ.get('GITQ_LOCK_TIMEOUT', 30))
+        if self.fd is None:
+            if not os.path.exists(self.qdir):
+                os.makedirs(self.qdir)
+            self.fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o666)
+            # Don't let git (or anything else we start) hang on to it
+            flags = fcntl.fcntl(self.fd, fcntl.F_GETFD)
+            fcntl.fcntl(self.fd, fcntl.F_SETFD, flags | fcntl.FD_CLOEXEC)
+
+        mode = fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH
+        deadline = time.time() + timeout
+        while True:
+            try:
+                fcntl.flock(self.fd, mode | fcntl.LOCK_NB)
+                break
+            except IOError:
+                if time.time() >= deadline:
+                    pgl.die('Timed out waiting for the queue lock held by %s' %
+                        (self._describe_owner(),))
+                time.sleep(0.05)
+
+        self.exclusive = exclusive
+        if exclusive:
+            import socket
+            _exclusive_locks.add(self.qdir)
+            os.ftruncate(self.fd, 0)
+            os.lseek(self.fd, 0, os.SEEK_SET)
+            os.write(self.fd, '%d\n%s\n%s\n' % (os.getpid(),
+                socket.gethostname(), ' '.join([os.path.basename(sys.argv[0])]
+                                               + sys.argv[1:])))
+
+    def release(self):
+        if self.fd is None:
+            return
+        import fcntl
+        if self.exclusive:
+            _exclusive_locks.discard(self.qdir)
+            os.ftruncate(self.fd, 0)
+        fcntl.flock(self.fd, fcntl.LOCK_UN)
+        os.close(self.fd)
+        self.fd = None
+        self.exclusive = False
+
+@traced('lock')
+def lock_queue(exclusive=False):
+    """Lock the current branch queue until we exit: shared for commands that
+    only read it, exclusive for ones that change it
+    """
+    lock = pgl.config.get('QUEUE_LOCK')
+    if lock is not None and lock.qdir != pgl.config['BRANCH_QUEUE']:
+        lock.release()
+        lock = None
+    if lock is None:
+        lock = pgl.config['QUEUE_LOCK'] = QueueLock(pgl.config['BRANCH_QUEUE'])
+        # Clear out our name on the way out, so only a crash leaves it behind
+        atexit.register(lock.release)
+    lock.acquire(exclusive)
+
+def unlock_queue():
+    lock = pgl.config.get('QUEUE_LOCK')
+    if lock is not None:
+        lock.release()
+
+@traced('load_series')
+def load_series():
+    """Read queue series info from the metadata store
+    """
+    state = queue_store().state
+    pgl.config['SERIES'] = list(state['series'])
+    pgl.config['UNAPPLIED'] = list(state['unapplied'])
+    pgl.config['NAMES'] = dict(state['names'])
+    pgl.config['SHAS'] = dict((name, sha)
+                              for sha, name in state['names'].iteritems())
+    pgl.config['ACTIVE_PATCH'] = None
     if pgl.config['SERIES']:
         pgl.config['ACTIVE_PATCH'] = pgl.config['SERIES'][-1]
 
-    with file(pgl.config['UNAPPLIED_PATCHES']) as f:
-        for line in f:
-            pgl.config['UNAPPLIED'].append(line.strip())
+@traced('write_series')
+def write_series():
+    """Write queue series info to the metadata store in one transaction
+    """
+    queue_store().commit(pgl.config['SERIES'], pgl.config['UNAPPLIED'],
+                         pgl.config['NAMES'])
 
-    with file(pgl.config['SHA_NAME_MAP']) as f:
-        for line in f:
-            sha, name = line.strip().split(' ', 1)
-            pgl.config['NAMES'][sha] = name
-            pgl.config['SHAS'][name] = sha
+class PatchCache(object):
+    """What each patch in a branch queue looks like (subject, author, files
+    and line ranges touched, diffstat and the trees at either end), so
+    listing the queue doesn't have to ask git about every patch. Entries are
+    keyed by patch name and carry the base and tip commits they were made
+    from, so a patch that's been refreshed, pushed or rewritten behind our
+    back just looks like a miss.
+    """
+    VERSION = 2
 
-def write_series():
-    """Write queue series info to the metadata file
+    def __init__(self, qdir):
+        self.qdir = qdir
+        self.path = os.path.join(qdir, 'patchcache')
+        self._entries = None
+        self.dirty = False
+
+    @property
+    def entries(self):
+        if self._entries is None:
+            import json
+            self._entries = {}
+            try:
+                with file(self.path) as f:
+                    data = json.load(f)
+                if data.get('version') == self.VERSION:
+                    self._entries = data['patches']
+            except (IOError, ValueError, KeyError, AttributeError):
+                # Missing or damaged, it's only a cache
+                pass
+        return self._entries
+
+    def get(self, name, base, tip):
+        """Return the cached entry for name if it's still current, or None
+        """
+        entry = self.entries.get(name)
+        if entry is None or entry['base'] != base or entry['tip'] != tip:
+            return None
+        return entry
+
+    def fill(self, name, base, tip):
+        """Work out the entry for a patch from git and remember it
+        """
+        gs = session()
+        info = gs.commit_info(base)
+        if info is None:
+            return None
+        base_tree = gs.rev_parse('%s~1^{tree}' % (base,))
+        tip_tree = gs.rev_parse('%s^{tree}' % (tip,))
+        files = []
+        hunks = {}
+        added = removed = 0
+        # The numstat comes first, then the patch for each file in the same
+        # order. Hunks are kept as [first line, line count] on the old side.
+        current = -1
+        for line in gs.lines(['diff-tree', '-r', '--numstat', '-p', '-U0',
+                              base_tree, tip_tree]) or []:
+            if line.startswith('diff --git '):
+                current += 1
+                continue
+            if line.startswith('@@ -') and 0 <= current < len(files):
+                old = line[4:].split(' ', 1)[0].split(',')
+                count = int(old[1]) if len(old) > 1 else 1
+                hunks.setdefault(files[current], []).append([int(old[0]),
+                                                             count])
+                continue
+            if current >= 0:
+                continue
+            bits = line.split('\t', 2)
+            if len(bits) != 3:
+                continue
+            files.append(bits[2])
+            if bits[0] != '-':
+                # Binary files show up as - -
+                added += int(bits[0])
+                removed += int(bits[1])
+        entry = {'base': base, 'tip': tip, 'base_tree': base_tree,
+                 'tip_tree': tip_tree,
+                 'subject': info['message'].split('\n', 1)[0].strip(),
+                 'author': info['author'], 'files': files, 'hunks': hunks,
+                 'diffstat': [len(files), added, removed]}
+        self.entries[name] = entry
+        self.dirty = True
+        return entry
+
+    def lookup(self, name, base, tip):
+        entry = self.get(name, base, tip)
+        if entry is None:
+            entry = self.fill(name, base, tip)
+        return entry
+
+    def save(self, names):
+        """Drop entries for patches that are gone and write the cache out if
+        anything changed
+        """
+        import json
+        for name in self.entries.keys():
+            if name not in names:
+                del self.entries[name]
+                self.dirty = True
+        if not self.dirty or not os.path.exists(self.qdir):
+            return
+        atomic_write(self.path, json.dumps({'version': self.VERSION,
+                                            'patches': self.entries}))
+        self.dirty = False
+
+def patch_cache():
+    """Return the patch metadata cache for the current branch queue
+    """
+    if pgl.config.get('PATCH_CACHE') is None:
+        pgl.config['PATCH_CACHE'] = PatchCache(pgl.config['BRANCH_QUEUE'])
+    return pgl.config['PATCH_CACHE']
+
+class DiffCache(object):
+    """git diff output between the trees at either end of a patch, so asking
+    for a patch's diff over and over (editors do) doesn't rerun git each
+    time. The diff between two trees never changes, so entries are keyed by
+    the tree pair and only go away once no patch in the queue has those
+    ends any more.
+    """
+    MODES = {'patch': [], 'stat': ['--stat'], 'names': ['--name-only']}
+
+    def __init__(self, qdir):
+        self.path = os.path.join(qdir, 'diffcache')
+
+    def _file(self, frm, to, mode):
+        return os.path.join(self.path, '%s-%s.%s' % (frm, to, mode))
+
+    def get(self, frm, to, mode='patch'):
+        """Return the diff from tree frm to tree to, as patch, stat or names
+        """
+        fname = self._file(frm, to, mode)
+        try:
+            with file(fname) as f:
+                return f.read()
+        except IOError:
+            pass
+        rval, out = session().run(['diff', '--no-color', '--no-ext-diff'] +
+                                  self.MODES[mode] + [frm, to])
+        if rval:
+            pgl.die('Failed to diff %s and %s' % (frm, to))
+        try:
+            if not os.path.exists(self.path):
+                os.makedirs(self.path)
+            atomic_write(fname, out)
+        except (IOError, OSError):
+            # Someone else got there first, or we can't write; it's only a
+            # cache
+            pass
+        return out
+
+    def prune(self, keep):
+        """Drop the diffs for tree pairs that aren't in keep
+        """
+        if not os.path.isdir(self.path):
+            return
+        for entry in os.listdir(self.path):
+            if tuple(entry.split('.', 1)[0].split('-', 1)) not in keep:
+                try:
+                    os.unlink(os.path.join(self.path, entry))
+                except OSError:
+                    pass
+
+def diff_cache():
+    """Return the diff cache for the current branch queue
+    """
+    return DiffCache(pgl.config['BRANCH_QUEUE'])
+
+def patch_ends(base):
+    """Return (base, tip) for the patch starting at base, wherever it is.
+    The tip is None for a patch parked by an older gitq.
+    """
+    if base in pgl.config['SERIES']:
+        return base, patch_tip(base)
+    return base, session().rev_parse(patch_ref(pgl.config['NAMES'][base]))
+
+def patch_info(base):
+    """Return the cache entry for the patch starting at base, filling it in
+    if it's missing or stale. Returns None if we can't tell.
+    """
+    base, tip = patch_ends(base)
+    if tip is None:
+        return None
+    return patch_cache().lookup(pgl.config['NAMES'][base], base, tip)
+
+def update_patch_cache(bases):
+    """Bring the cache up to date for the given patches (ones that were just
+    created or moved) and save it
+    """
+    for base in bases:
+        patch_info(base)
+    cache = patch_cache()
+    cache.save(set(pgl.config['NAMES'].itervalues()))
+    diff_cache().prune(set((e['base_tree'], e['tip_tree'])
+                           for e in cache.entries.itervalues()))
+
+def _overlaps(a, b):
+    """Return True if any of the line ranges in a and b overlap or sit right
+    next to each other, which merges treat as a conflict too. Insertions (no
+    old lines) are counted as touching the line they go after.
+    """
+    for astart, acount in a:
+        for bstart, bcount in b:
+            if astart <= bstart + max(bcount, 1) and \
+               bstart <= astart + max(acount, 1):
+                return True
+    return False
+
+@traced('graph')
+def conflict_graph(bases):
+    """Work out which of the given patches get in each other's way, from the
+    files and hunks in the patch cache. Returns {base: {other base: kind}},
+    where kind is 'hunk' if both change the same lines and 'file' if they
+    only change the same files. Line numbers are relative to each patch's
+    own base, so 'hunk' is a strong hint rather than a promise.
+    """
+    infos = {}
+    touched = {}
+    for base in bases:
+        info = patch_info(base)
+        infos[base] = info
+        if info is None:
+            continue
+        for path in info['files']:
+            touched.setdefault(path, []).append(base)
+
+    graph = dict((base, {}) for base in bases)
+    for path, users in touched.iteritems():
+        for i, a in enumerate(users):
+            for b in users[i + 1:]:
+                kind = 'file'
+                if _overlaps(infos[a]['hunks'].get(path, []),
+                             infos[b]['hunks'].get(path, [])):
+                    kind = 'hunk'
+                if graph[a].get(b) != 'hunk':
+                    graph[a][b] = graph[b][a] = kind
+    patch_cache().save(set(pgl.config['NAMES'].itervalues()))
+    return graph
+
+def independent_groups(graph, bases):
+    """Split bases into groups that don't touch each other at all, which can
+    be exported, tested or reordered separately. Groups keep the order of
+    bases.
+    """
+    group = {}
+    groups = []
+    for base in bases:
+        if base in group:
+            continue
+        members = set([base])
+        todo = [base]
+        while todo:
+            for other in graph[todo.pop()]:
+                if other not in members:
+                    members.add(other)
+                    todo.append(other)
+        for m in members:
+            group[m] = len(groups)
+        groups.append([b for b in bases if b in members])
+    return groups
+
+def patch_subject(base):
+    """Return the subject of the patch starting at base, from the cache if
+    we've seen it
+    """
+    entry = patch_cache().entries.get(pgl.config['NAMES'].get(base))
+    if entry is not None and entry['base'] == base:
+        return entry['subject']
+    return session().subject(base)
+
+class PatchPack(object):
+    """Patches parked by older versions of gitq, which saved every popped
+    patch as a directory of format-patch mails, packed into one file per
+    branch queue. Each mail is zlib-compressed on its own, and a small text
+    index records where it lives, so one patch can be read out through an
+    mmap without unpacking the rest.
+
+    The index names the pack file it describes. Compaction writes a new pack
+    under a new name, then swaps the index in with a rename, so readers
+    always see a consistent pair.
+    """
+    MAGIC = 'gitq-pack 1'
+
+    def __init__(self, qdir):
+        self.qdir = qdir
+        self.index = os.path.join(qdir, 'parked.idx')
+        self._entries = None
+        self._pack = None
+
+    def exists(self):
+        return os.path.exists(self.index)
+
+    def _load(self):
+        self._entries = {}
+        self._pack = None
+        if not self.exists():
+            return
+        with file(self.index) as f:
+            header = f.readline().rstrip('\n')
+            if not header.startswith(self.MAGIC + ' '):
+                pgl.die('Unknown patch pack format in %s' % (self.qdir,))
+            self._pack = header[len(self.MAGIC) + 1:]
+            for line in f:
+                base, fname, offset, length = line.rstrip('\n').split('\t')
+                self._entries.setdefault(base, []).append(
+                    (fname, int(offset), int(length)))
+
+    @property
+    def entries(self):
+        if self._entries is None:
+            self._load()
+        return self._entries
+
+    def __contains__(self, base):
+        return base in self.entries
+
+    def _pack_path(self, name=None):
+        return os.path.join(self.qdir, name or self._pack)
+
+    def read(self, base):
+        """Return [(file name, contents)] for the patch starting at base
+        """
+        import mmap
+        import zlib
+
+        members = self.entries.get(base)
+        if not members:
+            return []
+        with file(self._pack_path()) as f:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                return [(fname, zlib.decompress(mm[off:off + length]))
+                        for fname, off, length in members]
+            finally:
+                mm.close()
+
+    def _write(self, entries, blobs):
+        """Write a new pack and index holding entries, where blobs gives the
+        compressed data for each (base, file name)
+        """
+        gen = 0
+        if self._pack is not None:
+            gen = int(self._pack.split('.')[1]) + 1
+        name = 'parked.%d.pack' % (gen,)
+        lines = ['%s %s\n' % (self.MAGIC, name)]
+        new = {}
+        with file(self._pack_path(name), 'wb') as f:
+            for base in sorted(entries):
+                for fname, _, _ in entries[base]:
+                    data = blobs[(base, fname)]
+                    lines.append('%s\t%s\t%d\t%d\n' %
+                                 (base, fname, f.tell(), len(data)))
+                    new.setdefault(base, []).append(
+                        (fname, f.tell(), len(data)))
+                    f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        atomic_write(self.index, ''.join(lines))
+        if self._pack is not None and self._pack != name:
+            os.unlink(self._pack_path())
+        self._pack = name
+        self._entries = new
+
+    def _blobs(self):
+        """Return the compressed data for everything in the pack
+        """
+        blobs = {}
+        if not self.entries:
+            return blobs
+        with file(self._pack_path(), 'rb') as f:
+            for base, members in self.entries.iteritems():
+                for fname, off, length in members:
+                    f.seek(off)
+                    blobs[(base, fname)] = f.read(length)
+        return blobs
+
+    def add(self, patches):
+        """Pack {base: [(file name, contents)]}
+        """
+        import zlib
+
+        entries = dict(self.entries)
+        blobs = self._blobs()
+        for base, files in patches.iteritems():
+            entries[base] = [(fname, 0, 0) for fname, _ in files]
+            for fname, data in files:
+                blobs[(base, fname)] = zlib.compress(data, 9)
+        self._write(entries, blobs)
+
+    def remove(self, base):
+        """Forget the patch starting at base. The pack is rewritten without
+        it (and everything else that's been removed) once there's more dead
+        space in it than live data.
+        """
+        if base not in self.entries:
+            return
+        del self.entries[base]
+        live = sum(length for members in self.entries.itervalues()
+                   for _, _, length in members)
+        size = os.path.getsize(self._pack_path())
+        if not self.entries:
+            os.unlink(self._pack_path())
+            os.unlink(self.index)
+            self._pack = None
+        elif size - live > live:
+            self._write(self.entries, self._blobs())
+        else:
+            lines = ['%s %s\n' % (self.MAGIC, self._pack)]
+            for b in sorted(self.entries):
+                for fname, off, length in self.entries[b]:
+                    lines.append('%s\t%s\t%d\t%d\n' % (b, fname, off, length))
+            atomic_write(self.index, ''.join(lines))
+
+def patch_pack():
+    """Return the pack of old-style parked patches for the current queue
     """
-    with file(pgl.config['QUEUE_SERIES'], 'w') as f:
-        for base in pgl.config['SERIES']:
-            f.write('%s\n' % (base,))
+    if pgl.config.get('PATCH_PACK') is None:
+        pgl.config['PATCH_PACK'] = PatchPack(pgl.config['BRANCH_QUEUE'])
+    return pgl.config['PATCH_PACK']
 
-    with file(pgl.config['UNAPPLIED_PATCHES'], 'w') as f:
-        for base in pgl.config['UNAPPLIED']:
-            f.write('%s\n' % (base,))
+def saved_patches(base):
+    """Return [(file name, contents)] for a patch parked by an older gitq,
+    from its directory or from the pack
+    """
+    import glob
+
+    patchdir = os.path.join(pgl.config['BRANCH_QUEUE'], base)
+    if os.path.isdir(patchdir):
+        patches = []
+        for p in sorted(glob.glob(os.path.join(patchdir, '*.patch'))):
+            with file(p) as f:
+                patches.append((os.path.basename(p), f.read()))
+        return patches
+    return patch_pack().read(base)
 
-    with file(pgl.config['SHA_NAME_MAP'], 'w') as f:
-        for sha, name in pgl.config['NAMES'].iteritems():
-            f.write('%s %s\n' % (sha, name))
+def _has_output(args):
+    """Return True if git prints anything for args. We stop reading (and
+    stop git) as soon as the first line shows up.
+    """
+    devnull = file(os.devnull, 'w')
+    proc = session().popen(args, stderr=devnull)
+    devnull.close()
+    line = proc.stdout.readline()
+    if line:
+        proc.kill()
+    proc.stdout.close()
+    proc.wait()
+    return bool(line)
 
-def repo_has_changes():
-    """Return True if the working copy has uncommitted changes, False otherwise
+def _untracked_helpers():
+    """Return True if the untracked cache or fsmonitor are turned on, in
+    which case git status is the fastest way to find untracked files
     """
-    gitstat = subprocess.Popen(['git', 'status', '--porcelain'],
-        stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    status = gitstat.stdout.readlines()
-    if gitstat.wait() == 0 and status:
-        if any((s[0] != '#' for s in status)):
+    if 'UNTRACKED_HELPERS' not in pgl.config:
+        lines = session().lines(['config', '--get-regexp',
+                                 '^core\\.(untrackedcache|fsmonitor)$'])
+        helpers = False
+        for line in lines or []:
+            _, _, val = line.partition(' ')
+            if val.lower() not in ('false', 'no', 'off', '0', ''):
+                helpers = True
+        pgl.config['UNTRACKED_HELPERS'] = helpers
+    return pgl.config['UNTRACKED_HELPERS']
+
+@traced('dirty_check')
+def repo_has_changes(untracked=True, worktree=True):
+    """Return True if the working copy has uncommitted changes, False otherwise.
+    Checks are done cheapest first and stop at the first change: index against
+    HEAD, then (if worktree) working copy against the index, then (if
+    untracked) untracked files.
+    """
+    require_worktree()
+    gs = session()
+    rval, _ = gs.run(['diff-index', '--cached', '--quiet', 'HEAD', '--'])
+    if rval == 1:
+        return True
+    elif rval:
+        # No HEAD yet, anything in the index is a change
+        if _has_output(['ls-files']):
+            return True
+
+    if worktree:
+        rval, _ = gs.run(['--no-optional-locks', 'diff', '--no-ext-diff',
+                          '--quiet'])
+        if rval:
             return True
+
+    if untracked:
+        if _untracked_helpers():
+            # status can use the helpers, but it reports tracked changes too,
+            # which we may have been asked to ignore, so only count ?? lines
+            return _has_untracked_status()
+        return _has_output(['ls-files', '--others', '--exclude-standard',
+                            '--directory', '--no-empty-directory'])
+
     return False
 
+def _has_untracked_status():
+    """Return True if git status lists any untracked files, stopping at the
+    first one
+    """
+    devnull = file(os.devnull, 'w')
+    proc = session().popen(['--no-optional-locks', 'status', '--porcelain',
+                            '--untracked-files=normal'], stderr=devnull)
+    devnull.close()
+    found = False
+    for line in iter(proc.stdout.readline, ''):
+        if line.startswith('?? '):
+            found = True
+            proc.kill()
+            break
+    proc.stdout.close()
+    proc.wait()
+    return found
+
+@traced('commit')
 def update_patch(commit_all=False, commitmsg=None, new=False, name=None, email=None):
     """Makes sure we've committed all our changes, and write the patch series
     for this uber-patch to its patch directory
@@ -108,20 +1425,19 @@ def update_patch(commit_all=False, commitmsg=None, new=False, name=None, email=N
 
     # Now we can go through and make our new revision of the patch
     if patchbase and not commitmsg:
-        gitlog = subprocess.Popen(['git', 'log', '-1', '--format=%s',
-                                   patchbase],
-            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        origmsg = gitlog.stdout.readlines()[0].strip()
+        origmsg = patch_subject(patchbase)
         commitmsg = 'fixup! %s' % (origmsg,)
-        gitlog.wait()
 
-    # Can't use repo_has_changes, since that's not quite what we're looking for
-    if not repo_has_changes():
+    require_worktree()
+
+    # Only staged changes matter unless we're committing everything, and
+    # untracked files never make it into the commit
+    if not repo_has_changes(untracked=False, worktree=commit_all):
         pgl.warn('No changes to add to patch')
         return False
 
-    genv = copy.deepcopy(os.environ)
-    args = ['git', 'commit']
+    genv = dict(os.environ)
+    args = ['commit']
     if commit_all:
         args.append('-a')
     if commitmsg:
@@ -130,8 +1446,476 @@ def update_patch(commit_all=False, commitmsg=None, new=False, name=None, email=N
         genv['GIT_AUTHOR_NAME'] = name
     if email:
         genv['GIT_AUTHOR_EMAIL'] = email
-    gitcommit = subprocess.Popen(args, env=genv)
-    if gitcommit.wait():
+    if session().call(args, env=genv):
+        return False
+
+    return True
+
+def patch_tip(base):
+    """Return the last commit of the applied patch starting at base
+    """
+    series = pgl.config['SERIES']
+    i = series.index(base)
+    if i == len(series) - 1:
+        return pgl.config['HEAD_SHA']
+    return session().rev_parse('%s~1' % (series[i + 1],))
+
+def patch_commits(base, tip):
+    """Return the commits making up a patch, oldest first
+    """
+    return session().lines(['rev-list', '--reverse', '%s~1..%s' % (base, tip)])
+
+def temp_index(tag):
+    """Return an environment pointing git at a private index file, so we can
+    build trees without touching the real index or the working copy
+    """
+    path = os.path.join(pgl.config['QUEUES'], 'index.%s.%d' %
+                        (tag, os.getpid()))
+    env = dict(os.environ)
+    env['GIT_INDEX_FILE'] = path
+    atexit.register(lambda: os.path.exists(path) and os.unlink(path))
+    return env
+
+def read_diff(path):
+    """Read a diff from path, or from stdin if path is -
+    """
+    if path == '-':
+        return sys.stdin.read()
+    if not os.path.exists(path):
+        pgl.die('No such file: %s' % (path,))
+    with file(path) as f:
+        return f.read()
+
+def diff_to_tree(diff, commit):
+    """Apply diff to the tree of commit in a private index. Returns the
+    resulting tree, or None if the diff doesn't apply. The real index and the
+    working copy are never touched.
+    """
+    gs = session()
+    env = temp_index('diff')
+    if gs.run(['read-tree', commit], env=env)[0]:
+        pgl.die('Failed to read tree for %s' % (commit,))
+    proc = gs.popen(['apply', '--cached'], stdin=subprocess.PIPE, env=env)
+    _, err = proc.communicate(diff)
+    if proc.returncode:
+        sys.stderr.write(err)
+        return None
+    rval, out = gs.run(['write-tree'], env=env)
+    if rval:
+        pgl.die('Failed to write tree')
+    return out.strip()
+
+def own_ident():
+    """Return our author identity with the current time, the way it goes in
+    a commit header
+    """
+    rval, out = session().run(['var', 'GIT_AUTHOR_IDENT'])
+    if rval:
+        pgl.die('Could not figure out who you are')
+    return out.strip()
+
+def apply_diff(env, frm, to, check=False, context=None):
+    """Apply the difference between two trees to the index in env. Returns
+    (success, error output from git apply). context lowers how many lines of
+    context have to match, for applying with fuzz.
+    """
+    gs = session()
+    devnull = file(os.devnull, 'w')
+    diff = gs.popen(['diff-tree', '-p', '--binary', '--full-index', frm, to],
+        stderr=devnull)
+    args = ['apply', '--cached']
+    if check:
+        args.append('--check')
+    if context is not None:
+        args.append('-C%d' % (context,))
+    gitapply = gs.popen(args, stdin=diff.stdout, env=env)
+    diff.stdout.close()
+    _, err = gitapply.communicate()
+    diff.wait()
+    devnull.close()
+    return gitapply.returncode == 0, err
+
+def _apply_failures(err):
+    """Return the files git apply complained about, in order
+    """
+    files = []
+    for line in err.splitlines():
+        if not line.startswith('error: '):
+            continue
+        line = line[len('error: '):]
+        if line.startswith('patch failed: '):
+            path = line[len('patch failed: '):].rsplit(':', 1)[0]
+        elif ': ' in line:
+            path = line.rsplit(': ', 1)[0]
+        else:
+            continue
+        if path not in files:
+            files.append(path)
+    return files
+
+def check_patch(env, base, tip):
+    """See whether the parked patch from base to tip applies to the index in
+    env, without changing anything. Returns (status, files), where status is
+    'clean', 'fuzz' (applies with less context), 'conflict' or 'missing', and
+    files are the ones that needed fuzz or didn't apply.
+    """
+    gs = session()
+    if tip is not None:
+        rval, diff = gs.run(['diff-tree', '-p', '--binary', '--full-index',
+                             '%s~1' % (base,), tip])
+        if rval:
+            return 'missing', []
+    else:
+        # Saved by an older gitq, git apply can read the mails directly
+        patches = saved_patches(base)
+        if not patches:
+            return 'missing', []
+        diff = ''.join(data for _, data in patches)
+
+    failed = None
+    for status, args in (('clean', []), ('fuzz', ['-C1'])):
+        proc = gs.popen(['apply', '--cached', '--check'] + args,
+            stdin=subprocess.PIPE, env=env)
+        _, err = proc.communicate(diff)
+        if proc.returncode == 0:
+            return status, _apply_failures(failed or '')
+        if failed is None:
+            failed = err
+    return 'conflict', _apply_failures(failed)
+
+@traced('check')
+def check_patches(bases, jobs=None):
+    """Check parked patches against HEAD in a pool of threads. Each patch is
+    tried on its own, not on top of the others. Returns a list of
+    (base, status, files) in the same order as bases.
+    """
+    import multiprocessing
+    from multiprocessing.pool import ThreadPool
+
+    gs = session()
+    env = temp_index('check')
+    if gs.run(['read-tree', pgl.config['HEAD_SHA']], env=env)[0]:
+        pgl.die('Failed to read HEAD')
+
+    # Look up every tip (and load the pack index) before starting any
+    # threads, so the long-lived cat-file process can't inherit another
+    # thread's pipes
+    patch_pack().entries
+    work = [(base, gs.rev_parse(patch_ref(pgl.config['NAMES'][base])))
+            for base in bases]
+    if not work:
+        return []
+
+    def one(item):
+        base, tip = item
+        return (base,) + check_patch(env, base, tip)
+
+    pool = ThreadPool(min(jobs or multiprocessing.cpu_count(), len(work)))
+    try:
+        return pool.map(one, work)
+    finally:
+        pool.close()
+        pool.join()
+
+def commit_tree(tree, parents, author, message, env=None):
+    """Create a commit object without going near HEAD, the index or the
+    working copy. Returns the new commit's sha.
+    """
+    args = ['commit-tree', tree]
+    for p in parents:
+        args += ['-p', p]
+    rval, out = session().run(args, input=message,
+                              env=ident_env(author, env=env))
+    if rval:
+        pgl.die('Failed to create commit')
+    return out.strip()
+
+@traced('replay')
+def replay(commits, onto, env=None):
+    """Replay commits on top of onto using only the object database.
+    Returns (new tip, {old sha: new sha}, first commit that didn't apply).
+    Commits that already sit on the right parent are reused as-is.
+    """
+    gs = session()
+    cur = onto
+    mapping = {}
+    index_tree = None
+    for c in commits:
+        info = gs.commit_info(c)
+        parent = info['parents'][0] if info['parents'] else None
+        if parent == cur:
+            mapping[c] = cur = c
+            continue
+
+        cur_tree = gs.rev_parse('%s^{tree}' % (cur,))
+        parent_tree = gs.rev_parse('%s^{tree}' % (parent,))
+        if cur_tree == parent_tree:
+            tree = info['tree']
+        elif parent_tree == info['tree']:
+            tree = cur_tree
+        else:
+            if env is None:
+                env = temp_index('replay')
+            if index_tree != cur_tree:
+                if gs.run(['read-tree', cur_tree], env=env)[0]:
+                    pgl.die('Failed to read tree %s' % (cur_tree,))
+            ok, _ = apply_diff(env, parent, c)
+            if not ok:
+                return cur, mapping, c
+            rval, out = gs.run(['write-tree'], env=env)
+            if rval:
+                pgl.die('Failed to write tree')
+            tree = index_tree = out.strip()
+        cur = commit_tree(tree, [cur], info['author'], info['message'])
+        mapping[c] = cur
+    return cur, mapping, None
+
+def update_refs(updates):
+    """Apply a list of (ref, new sha or None to delete) in one transaction
+    """
+    lines = []
+    for ref, sha in updates:
+        if sha is None:
+            lines.append('delete %s\n' % (ref,))
+        else:
+            lines.append('update %s %s\n' % (ref, sha))
+    if not lines:
+        return True
+    rval, _ = session().run(['update-ref', '--stdin'], input=''.join(lines))
+    return rval == 0
+
+def branch_checked_out():
+    """Return True if the queue's branch is the one checked out here
+    """
+    gs = session()
+    if gs.run(['rev-parse', '--is-bare-repository'])[1].strip() == 'true':
+        return False
+    rval, out = gs.run(['symbolic-ref', '-q', 'HEAD'])
+    return not rval and \
+           out.strip() == 'refs/heads/%s' % (pgl.config['BRANCH'],)
+
+def require_worktree():
+    """Die if the queue's branch isn't checked out, which can only happen
+    when GITQ_BRANCH picks another one
+    """
+    if os.environ.get('GITQ_BRANCH') and not branch_checked_out():
+        pgl.die('%s is not checked out here, only --from-diff works on it' %
+            (pgl.config['BRANCH'],))
+
+def set_branch_tip(sha, message):
+    """Point the queue's branch at sha. If it's checked out here the working
+    copy follows, otherwise only the ref moves.
+    """
+    if branch_checked_out():
+        return move_head(sha)
+    rval, _ = session().run(['update-ref', '-m', message,
+        'refs/heads/%s' % (pgl.config['BRANCH'],), sha,
+        pgl.config['HEAD_SHA']])
+    if rval:
+        return False
+    pgl.config['HEAD_SHA'] = sha
+    return True
+
+def move_head(sha):
+    """Point HEAD (and the working copy) at sha. Like reset --hard, except
+    that it refuses to overwrite untracked files.
+    """
+    require_worktree()
+    gs = session()
+    if gs.call(['read-tree', '-m', '-u', 'HEAD', sha]):
+        return False
+    if gs.run(['update-ref', '-m', 'gitq: moving to %s' % (sha,), 'HEAD',
+               sha, pgl.config['HEAD_SHA']])[0]:
         return False
+    pgl.config['HEAD_SHA'] = sha
+    return True
+
+@traced('pop')
+def pop_patches(count):
+    """Park the top count applied patches under refs/queue and reset the
+    working copy to below them. Returns the list of popped patch bases.
+    """
+    require_worktree()
+    gs = session()
+    series = pgl.config['SERIES']
+    popped = series[-count:]
+    updates = []
+    tip = pgl.config['HEAD_SHA']
+    for base in reversed(popped):
+        updates.append((patch_ref(pgl.config['NAMES'][base]), tip))
+        tip = gs.rev_parse('%s~1' % (base,))
+
+    if not update_refs(updates):
+        pgl.die('Failed to save patches')
+
+    if not move_head(tip):
+        update_refs([(ref, None) for ref, _ in updates])
+        pgl.die('Failed to pop patch')
+
+    pgl.config['SERIES'] = series[:-count]
+    pgl.config['UNAPPLIED'].extend(reversed(popped))
+    pgl.config['ACTIVE_PATCH'] = None
+    if pgl.config['SERIES']:
+        pgl.config['ACTIVE_PATCH'] = pgl.config['SERIES'][-1]
+    write_series()
+    update_patch_cache(popped)
+
+    return popped
+
+def rename_patch_base(old, new):
+    """Update the sha -> name maps after a patch gets a new base commit
+    """
+    name = pgl.config['NAMES'].pop(old)
+    pgl.config['NAMES'][new] = name
+    pgl.config['SHAS'][name] = new
+
+@traced('apply')
+def push_patches(bases):
+    """Replay parked patches onto HEAD, in order, without a working copy
+    rewrite per patch. Stops at the first patch that can't be replayed in
+    the object database (a conflict, or a patch saved by an older gitq).
+    Returns (list of pushed bases, base that stopped us or None).
+    """
+    gs = session()
+    onto = pgl.config['HEAD_SHA']
+    pushed = []
+    refs = []
+    failed = None
+    for base in bases:
+        ref = patch_ref(pgl.config['NAMES'][base])
+        tip = gs.rev_parse(ref)
+        if tip is None:
+            failed = base
+            break
+        commits = patch_commits(base, tip)
+        newtip, mapping, conflict = replay(commits, onto)
+        if conflict is not None:
+            failed = base
+            break
+        pushed.append((base, mapping[commits[0]]))
+        refs.append((ref, None))
+        onto = newtip
+
+    if not pushed:
+        return [], failed
+
+    if onto != pgl.config['HEAD_SHA'] and not move_head(onto):
+        pgl.die('Failed to update working copy')
+    update_refs(refs)
+
+    for base, newbase in pushed:
+        pgl.config['UNAPPLIED'].remove(base)
+        pgl.config['SERIES'].append(newbase)
+        rename_patch_base(base, newbase)
+    pgl.config['ACTIVE_PATCH'] = pgl.config['SERIES'][-1]
+    write_series()
+    update_patch_cache([newbase for _, newbase in pushed])
+
+    return [base for base, _ in pushed], failed
+
+def _worktree_tree(commit_all):
+    """Return the tree the next commit would get: the index, plus changes to
+    tracked files if commit_all. The real index is left alone.
+    """
+    gs = session()
+    if not commit_all:
+        rval, out = gs.run(['write-tree'])
+    else:
+        import shutil
+        env = temp_index('refresh')
+        index = os.environ.get('GIT_INDEX_FILE',
+                               os.path.join(pgl.config['GIT_DIR'], 'index'))
+        shutil.copyfile(index, env['GIT_INDEX_FILE'])
+        if gs.run(['add', '-u'], env=env)[0]:
+            pgl.die('Failed to add changes')
+        rval, out = gs.run(['write-tree'], env=env)
+    if rval:
+        pgl.die('Failed to write tree')
+    return out.strip()
+
+@traced('amend')
+def amend_patch(base, commit_all=False, newtree=None):
+    """Fold uncommitted changes into the patch starting at base, leaving it
+    as a single commit, and rebuild the patches above it on top with
+    commit-tree. HEAD moves to the new top of the series, the working copy
+    is left as it is. Returns False if the changes don't apply to the patch.
+
+    If newtree is given, it's folded in instead of the working copy: it's
+    the tree of HEAD with the changes applied. The branch then moves like
+    set_branch_tip.
+    """
+    gs = session()
+    series = pgl.config['SERIES']
+    head = pgl.config['HEAD_SHA']
+    fromdiff = newtree is not None
+    if not fromdiff:
+        require_worktree()
+        newtree = _worktree_tree(commit_all)
+
+    tip = patch_tip(base)
+    if tip != head:
+        # Carry the changes down to where this patch ends
+        env = temp_index('amend')
+        if gs.run(['read-tree', '%s^{tree}' % (tip,)], env=env)[0]:
+            pgl.die('Failed to read tree')
+        ok, _ = apply_diff(env, '%s^{tree}' % (head,), newtree)
+        if not ok:
+            return False
+        rval, out = gs.run(['write-tree'], env=env)
+        if rval:
+            pgl.die('Failed to write tree')
+        newtree = out.strip()
+
+    info = gs.commit_info(base)
+    cur = commit_tree(newtree, info['parents'], info['author'],
+                      info['message'])
+    rebased = [(base, cur)]
+
+    for above in series[series.index(base) + 1:]:
+        commits = patch_commits(above, patch_tip(above))
+        cur, mapping, conflict = replay(commits, cur)
+        if conflict is not None:
+            return False
+        rebased.append((above, mapping[commits[0]]))
+
+    if fromdiff:
+        if not set_branch_tip(cur, 'gitq: refresh'):
+            pgl.die('Failed to update %s' % (pgl.config['BRANCH'],))
+    else:
+        if gs.run(['update-ref', '-m', 'gitq: refresh', 'HEAD', cur,
+                   head])[0]:
+            pgl.die('Failed to update HEAD')
+        pgl.config['HEAD_SHA'] = cur
+        # Like reset --mixed, the index matches the new HEAD and the working
+        # copy keeps whatever wasn't folded in
+        if gs.call(['reset', '-q']):
+            pgl.die('Failed to reset index')
+
+    for old, new in rebased:
+        series[series.index(old)] = new
+        rename_patch_base(old, new)
+    pgl.config['ACTIVE_PATCH'] = series[-1]
+    write_series()
+    update_patch_cache([new for _, new in rebased])
 
     return True
+
+@traced('squash')
+def squash_series():
+    """Build one commit per applied patch with its fixups folded in, chained
+    on top of the base of the series. Each squashed commit simply takes the
+    tree of its patch's tip, so no diffing or merging is needed, and HEAD,
+    the index and the working copy are left alone. Returns a list of
+    (patch base, squashed commit).
+    """
+    gs = session()
+    series = pgl.config['SERIES']
+    parent = gs.rev_parse('%s~1' % (series[0],))
+    squashed = []
+    for base in series:
+        tip = patch_tip(base)
+        info = gs.commit_info(base)
+        tree = gs.rev_parse('%s^{tree}' % (tip,))
+        parent = commit_tree(tree, [parent], info['author'], info['message'])
+        squashed.append((base, parent))
+    return squashed
@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+
+import argparse
+import sys
+
+import gitq
+import pgl
+
+def report(results):
+    """Print how each patch would apply. Returns the number that conflict.
+    """
+    conflicts = 0
+    for base, status, files in results:
+        line = '%s: %s' % (pgl.config['NAMES'][base], status)
+        if files:
+            line += ' (%s)' % (', '.join(files),)
+        sys.stdout.write('%s\n' % (line,))
+        if status in ('conflict', 'missing'):
+            conflicts += 1
+    return conflicts
+
+@pgl.main
+def main():
+    ap = argparse.ArgumentParser(
+        description='Check which popped patches apply to HEAD',
+        prog='git qcheck')
+    ap.add_argument('pnames', help='Patches to check (default: all popped)',
+        nargs='*')
+    ap.add_argument('-j', dest='jobs', type=int, default=None,
+        help='Patches to check at once')
+    args = gitq.parse_args(ap)
+
+    gitq.include_config()
+    gitq.lock_queue()
+    if not gitq.queue_exists():
+        pgl.die('There is no git queue for branch %s here!' %
+            (pgl.config['BRANCH'],))
+    gitq.load_series()
+
+    if args.pnames:
+        bases = []
+        for name in args.pnames:
+            base = pgl.config['SHAS'].get(name)
+            if base not in pgl.config['UNAPPLIED']:
+                pgl.die('%s is not a popped patch' % (name,))
+            bases.append(base)
+    else:
+        # In the order qpush would take them
+        bases = list(reversed(pgl.config['UNAPPLIED']))
+
+    if not bases:
+        pgl.die('No patches for this branch!')
+
+    if report(gitq.check_patches(bases, jobs=args.jobs)):
+        return 1
+
+    return 0
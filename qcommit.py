@@ -1,10 +1,7 @@
 #!/usr/bin/env python
 
 import argparse
-import glob
 import os
-import shutil
-import subprocess
 import sys
 
 import gitq
@@ -28,13 +25,13 @@ def check_am_and_maybe_die(gitam):
         sys.exit(1)
 
 def do_cleanup(patchdir, abfile):
+    import shutil
+
     # Cleanup our temporary files
     shutil.rmtree(patchdir)
     os.unlink(abfile)
 
-def do_cleanup_and_empty_series(patchdir, abfile):
-    do_cleanup(patchdir, abfile)
-
+def empty_series():
     # These are no longer patches, so get them out of the series
     for sha in pgl.config['SERIES']:
         name = pgl.config['NAMES'][sha]
@@ -43,6 +40,11 @@ def do_cleanup_and_empty_series(patchdir, abfile):
     pgl.config['SERIES'] = []
     pgl.config['ACTIVE_PATCH'] = None
     gitq.write_series()
+    gitq.update_patch_cache([])
+
+def do_cleanup_and_empty_series(patchdir, abfile):
+    do_cleanup(patchdir, abfile)
+    empty_series()
 
 @pgl.main
 def main():
@@ -54,43 +56,38 @@ def main():
         help='Continue paused qcommit', default=False, action='store_true')
     ap.add_argument('--abort', dest='abort', help='Abort paused qcommit',
         default=False, action='store_true')
-    args = ap.parse_args()
-
-    if gitq.repo_has_changes():
-        pgl.die('Working copy has changes. Stash or commit to continue.')
+    args = gitq.parse_args(ap)
 
     gitq.include_config()
-    gitq.load_series()
-
     patchdir = os.path.join(pgl.config['QUEUES'], 'qcommit_patches')
     abfile = os.path.join(pgl.config['QUEUES'], 'abortbranch')
+    if (args.abort or args.resolved) and os.path.exists(abfile):
+        # We're on the destination branch, but the queue is the one we came
+        # from
+        with file(abfile) as f:
+            gitq.select_queue(f.readline().strip())
+    gitq.lock_queue(exclusive=True)
+    gitq.load_series()
+    gs = gitq.session()
 
     if args.abort:
         # Abort the underlying git-am
-        gitam = subprocess.Popen(['git', 'am', '--abort'])
-        gitam.wait()
+        gs.call(['am', '--abort'])
 
-        # Figure out our original branch was
-        abortbranch = None
+        # Figure out our original branch, and where the destination branch
+        # was before this mess started
         with file(abfile) as f:
-            abortbranch = f.read()
-
-        # Go back to our original branch
-        gc = subprocess.Popen(['git', 'checkout', '-b', abortbranch],
-            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        gc.wait()
-
-        # Figure out what commit we were at before this mess started
-        gsr = subprocess.Popen(['git', 'symbolic-ref', 'QPATCH_HEAD'],
-            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        lines = gsr.readlines()
-        gsr.wait()
-        sha = lines[0].strip()
-
-        # Reset to that commit so we're back where we started
-        gr = subprocess.Popen(['git', 'reset', '--hard', sha],
-            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        gr.wait()
+            abortbranch, branch, orig_sha = f.read().split('\n')[:3]
+
+        # Put the destination branch back, then go back to where we were.
+        # If we never got as far as checking it out, only the ref moved.
+        rval, head = gs.run(['symbolic-ref', '-q', 'HEAD'])
+        if not rval and head.strip() == 'refs/heads/%s' % (branch,):
+            gs.run(['reset', '--hard', orig_sha])
+            gs.run(['checkout', abortbranch])
+        else:
+            gs.run(['update-ref', '-m', 'qcommit: abort',
+                    'refs/heads/%s' % (branch,), orig_sha])
 
         do_cleanup(patchdir, abfile)
 
@@ -98,19 +95,23 @@ def main():
 
     if args.resolved:
         # Tell our underlying git-am to keep going
-        gitam = subprocess.Popen(['git', 'am', '--resolved', '--reject'],
-            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        gitam = gs.popen(['am', '--resolved', '--reject'])
         check_am_and_maybe_die(gitam)
 
         do_cleanup_and_empty_series(patchdir, abfile)
 
         return 0
 
+    if not pgl.config['SERIES']:
+        pgl.die('No patches to commit!')
+
     # Make sure we know where to apply our patches
-    grp = subprocess.Popen(['git', 'rev-parse', '--verify', args.branch],
-        stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    if grp.wait():
+    target_ref = 'refs/heads/%s' % (args.branch,)
+    target_sha = gs.rev_parse(target_ref)
+    if target_sha is None:
         pgl.die('Could not find branch %s' % (args.branch,))
+    if args.branch == pgl.config['BRANCH']:
+        pgl.die('Cannot commit a queue to the branch it is on')
 
     # Make sure our temporary patch location isn't already in use
     if os.path.exists(patchdir):
@@ -118,38 +119,68 @@ def main():
         pgl.die("It appears that another 'git qcommit' is already in progress.\n"
                 "Remove %s if that is not the case." % (patchdir[gitstart:],))
 
-    # Figure out what branch we're on
-    gb = subprocess.Popen(['git', 'branch', '--color=never', '--contains',
-                           'HEAD'],
-        stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    lines = gb.stdout.readlines()
-    gb.wait()
-    for l in lines:
-        if l.startswith('*'):
-            abortbranch = l.strip().split()[-1]
-            with file(abfile, 'w') as f:
-                f.write(abortbranch)
-            break
-
-    # Use our patch generator to create patches for git-am
-    gqp = subprocess.Popen(['git', 'qpatch', '--nocleanup', '-o', patchdir],
-        stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    if gqp.wait():
+    # Squash each patch down to one commit and replay those onto the
+    # destination branch, all in the object database. If the destination
+    # hasn't moved since the queue was started, this is just a ref update.
+    squashed = [sha for _, sha in gitq.squash_series()]
+    newtip, _, conflict = gitq.replay(squashed, target_sha)
+
+    def move_target():
+        if newtip == target_sha:
+            return
+        rval, _ = gs.run(['update-ref', '-m', 'qcommit', target_ref, newtip,
+                          target_sha])
+        if rval:
+            if os.path.exists(abfile):
+                os.unlink(abfile)
+            pgl.die('Branch %s changed while committing, try again' %
+                (args.branch,))
+
+    if conflict is None:
+        move_target()
+        sys.stdout.write('Committed %d patches to %s\n' %
+            (len(squashed), args.branch))
+        empty_series()
+        return 0
+
+    # There's a real conflict, so fall back to git-am in the working copy for
+    # whatever didn't replay cleanly. Don't touch the destination until we
+    # know we can go on, and can get back to where it was with --abort.
+    # Untracked files count too, since they could be in the way of checking
+    # out the destination.
+    if gitq.repo_has_changes():
+        pgl.die('Working copy has changes or untracked files. Stash or commit '
+                'to continue.')
+
+    rval, _ = gs.run(['format-patch', '-o', patchdir, '-n',
+                      '%s~1..%s' % (conflict, squashed[-1])])
+    if rval:
+        if os.path.exists(patchdir):
+            import shutil
+            shutil.rmtree(patchdir)
         pgl.die('Error exporting patches for commit')
 
+    with file(abfile, 'w') as f:
+        f.write('%s\n%s\n%s\n' % (pgl.config['BRANCH'], args.branch,
+                                  target_sha))
+    move_target()
+
     # Get our list of patches to apply
-    patches = glob.glob(os.path.join(patchdir, '*.patch'))
+    import glob
+    patches = sorted(glob.glob(os.path.join(patchdir, '*.patch')))
 
     # Go to our destination branch
-    gc = subprocess.Popen(['git', 'checkout', args.branch],
-        stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    gc.wait()
+    if gs.call(['checkout', args.branch]):
+        if newtip != target_sha:
+            gs.run(['update-ref', '-m', 'qcommit: abort', target_ref,
+                    target_sha, newtip])
+        do_cleanup(patchdir, abfile)
+        pgl.die('Could not check out %s' % (args.branch,))
 
     # Now run git am
-    gaargs = ['git', 'am', '--reject']
+    gaargs = ['am', '--reject']
     gaargs.extend(patches)
-    gitam = subprocess.Popen(gaargs, stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE)
+    gitam = gs.popen(gaargs)
     check_am_and_maybe_die(gitam)
 
     do_cleanup_and_empty_series(patchdir, abfile)
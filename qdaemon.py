@@ -0,0 +1,297 @@
+#!/usr/bin/env python
+"""A long-lived per-repository gitq server.
+
+It keeps the git session and the parsed queue metadata in memory and answers
+read-only questions (what's applied, what's parked, what's on top) over a Unix
+socket in the queue directory, so prompts and editors can ask many times a
+second without starting Python and git each time. Everything it knows is
+rebuilt when HEAD, the branch refs or the queue metadata change on disk.
+"""
+
+import argparse
+import json
+import os
+import socket
+import sys
+import threading
+import time
+
+import gitq
+import pgl
+
+def socket_path():
+    return os.path.join(pgl.config['GIT_DIR'], 'queue', 'daemon.sock')
+
+def _connect(path):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    if len(path) < 100:
+        sock.connect(path)
+        return sock
+
+    # Unix socket paths are short, so go there and use a relative path
+    cwd = os.getcwd()
+    os.chdir(os.path.dirname(path))
+    try:
+        sock.connect(os.path.basename(path))
+    finally:
+        os.chdir(cwd)
+    return sock
+
+def request(req):
+    """Send a request to the daemon for this repository. Returns its answer,
+    or None if there's no daemon to ask.
+    """
+    if os.environ.get('GITQ_NO_DAEMON') or 'GIT_DIR' not in pgl.config:
+        return None
+    path = socket_path()
+    if not os.path.exists(path):
+        return None
+    try:
+        sock = _connect(path)
+        f = sock.makefile('rw')
+        f.write(json.dumps(req) + '\n')
+        f.flush()
+        line = f.readline()
+        f.close()
+        sock.close()
+    except socket.error:
+        return None
+    if not line:
+        return None
+    return json.loads(line)
+
+class QueueState(object):
+    """The daemon's picture of the queue for whatever branch is checked out,
+    rebuilt whenever one of the files it came from changes
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.stamp = None
+        self.data = None
+        self.files = []
+
+    def _stamp(self):
+        gitdir = pgl.config['GIT_DIR']
+        paths = [os.path.join(gitdir, 'HEAD'),
+                 os.path.join(gitdir, 'packed-refs'),
+                 os.path.join(gitdir, 'refs', 'heads')] + self.files
+        stamp = []
+        for path in paths:
+            try:
+                st = os.stat(path)
+                stamp.append((st.st_mtime, st.st_size, st.st_ino))
+            except OSError:
+                stamp.append(None)
+        return stamp
+
+    def get(self):
+        with self.lock:
+            stamp = self._stamp()
+            if stamp != self.stamp or self.data is None:
+                self.data = self._load()
+                # Now we know which branch, watch its ref and queue too
+                self.stamp = self._stamp()
+            return self.data
+
+    def _load(self):
+        # Start over with git as well, so we don't trust anything cached
+        gitq.session().close()
+        gitq.include_config()
+        branch = pgl.config['BRANCH']
+        self.files = [
+            os.path.join(pgl.config['GIT_DIR'], 'refs', 'heads', branch),
+            os.path.join(pgl.config['BRANCH_QUEUE'], 'meta'),
+            os.path.join(pgl.config['BRANCH_QUEUE'], 'journal'),
+        ]
+        data = {'branch': branch, 'head': pgl.config['HEAD_SHA'],
+                'applied': [], 'unapplied': [], 'active': None}
+        pgl.config['QUEUE_STORE'] = None
+        if not gitq.queue_exists():
+            return data
+        # Don't read the queue while a command outside the daemon is
+        # halfway through changing it
+        gitq.lock_queue()
+        try:
+            gitq.load_series()
+        finally:
+            gitq.unlock_queue()
+        names = pgl.config['NAMES']
+        data['applied'] = [names[sha] for sha in pgl.config['SERIES']]
+        # Parked patches in the order qpush would take them
+        data['unapplied'] = [names[sha]
+                             for sha in reversed(pgl.config['UNAPPLIED'])]
+        if pgl.config['ACTIVE_PATCH']:
+            data['active'] = names[pgl.config['ACTIVE_PATCH']]
+        return data
+
+class Daemon(object):
+    def __init__(self, idle_timeout):
+        self.state = QueueState()
+        self.idle_timeout = idle_timeout
+        self.last_request = time.time()
+        self.server = None
+        self.path = None
+        self.inode = None
+        self.stopping = threading.Event()
+
+    def dispatch(self, req):
+        self.last_request = time.time()
+        op = req.get('op')
+        if op == 'ping':
+            return {'ok': True, 'pid': os.getpid()}
+        elif op == 'series':
+            try:
+                return self.state.get()
+            except SystemExit:
+                return {'error': 'Could not read queue'}
+        elif op == 'shutdown':
+            self.stop()
+            return {'ok': True}
+        return {'error': 'Unknown request %s' % (op,)}
+
+    def remove_socket(self):
+        """Remove our socket, unless it's already been replaced by another
+        daemon's
+        """
+        try:
+            if os.stat(self.path).st_ino == self.inode:
+                os.unlink(self.path)
+        except OSError:
+            pass
+
+    def stop(self):
+        """Stop taking new connections right away and shut down once the
+        requests already in hand are answered
+        """
+        if self.stopping.is_set():
+            return
+        self.stopping.set()
+        self.remove_socket()
+        # shutdown() waits for serve_forever() to notice, so it can't be
+        # called from the thread that's running it
+        threading.Thread(target=self.server.shutdown).start()
+
+    def watch_idle(self):
+        while not self.stopping.wait(min(60, self.idle_timeout)):
+            if time.time() - self.last_request > self.idle_timeout:
+                self.stop()
+
+    def serve(self, path):
+        import SocketServer
+
+        daemon = self
+
+        class Handler(SocketServer.StreamRequestHandler):
+            # Don't let a client that never sends anything hold up exit
+            timeout = 10
+
+            def handle(self):
+                line = self.rfile.readline()
+                try:
+                    resp = daemon.dispatch(json.loads(line))
+                except ValueError:
+                    resp = {'error': 'Bad request'}
+                self.wfile.write(json.dumps(resp) + '\n')
+
+        class Server(SocketServer.ThreadingMixIn,
+                     SocketServer.UnixStreamServer):
+            # Requests in progress get to finish before we exit
+            daemon_threads = False
+
+        # Bind relative to the queue directory, socket paths are short
+        # Only we get to talk to it, so the socket is created owner-only
+        # rather than fixed up after bind
+        cwd = os.getcwd()
+        os.chdir(os.path.dirname(path))
+        umask = os.umask(0o177)
+        try:
+            self.server = Server(os.path.basename(path), Handler)
+        finally:
+            os.umask(umask)
+            os.chdir(cwd)
+        os.chmod(path, 0o600)
+        self.path = path
+        self.inode = os.stat(path).st_ino
+
+        watcher = threading.Thread(target=self.watch_idle)
+        watcher.daemon = True
+        watcher.start()
+        try:
+            self.server.serve_forever()
+        finally:
+            self.stopping.set()
+            self.server.server_close()
+            self.remove_socket()
+
+def daemonize():
+    """Detach from the terminal. Returns True in the daemon, False in the
+    process that started it.
+    """
+    if os.fork():
+        return False
+    os.setsid()
+    if os.fork():
+        os._exit(0)
+    devnull = os.open(os.devnull, os.O_RDWR)
+    for fd in (0, 1, 2):
+        os.dup2(devnull, fd)
+    os.close(devnull)
+    return True
+
+@pgl.main
+def main():
+    ap = argparse.ArgumentParser(description='Run the gitq daemon',
+        prog='git qdaemon')
+    ap.add_argument('action', choices=['start', 'stop', 'status'],
+        nargs='?', default='status')
+    ap.add_argument('--foreground', dest='foreground', default=False,
+        action='store_true', help='Stay attached to the terminal')
+    ap.add_argument('--idle-timeout', dest='idle_timeout', type=int,
+        default=3600, help='Exit after this many idle seconds')
+    args = gitq.parse_args(ap)
+
+    gitq.check()
+    pgl.config['GIT_DIR'] = os.path.abspath(pgl.config['GIT_DIR'])
+    path = socket_path()
+
+    resp = request({'op': 'ping'})
+    if args.action == 'status':
+        if resp is None:
+            sys.stdout.write('Not running\n')
+            return 1
+        sys.stdout.write('Running as pid %d\n' % (resp['pid'],))
+        return 0
+
+    if args.action == 'stop':
+        if resp is None:
+            pgl.die('Not running')
+        request({'op': 'shutdown'})
+        # Don't return until it's really gone, so a start straight after
+        # doesn't race with it
+        for _ in range(100):
+            try:
+                os.kill(resp['pid'], 0)
+            except OSError:
+                return 0
+            time.sleep(0.1)
+        pgl.die('Daemon (pid %d) did not stop' % (resp['pid'],))
+
+    if resp is not None:
+        pgl.die('Already running as pid %d' % (resp['pid'],))
+    if os.path.exists(path):
+        # Left behind by a daemon that died
+        os.unlink(path)
+    if not os.path.exists(os.path.dirname(path)):
+        os.mkdir(os.path.dirname(path))
+
+    if not args.foreground and not daemonize():
+        # Don't return until the daemon is ready to answer
+        for _ in range(50):
+            if request({'op': 'ping'}) is not None:
+                return 0
+            time.sleep(0.1)
+        pgl.die('Daemon did not start')
+
+    Daemon(args.idle_timeout).serve(path)
+
+    return 0
@@ -1,13 +1,89 @@
 #!/usr/bin/env python
 
+import argparse
 import os
+import subprocess
+import sys
 
 import gitq
 import pgl
 
+def run_git(args):
+    if gitq.tracer() is not None:
+        # Run git as a child so it shows up in the trace
+        return gitq.session().call(args)
+    os.execvp('git', ['git'] + args)
+
+def show_saved(base, mode):
+    """Show a patch parked by an older gitq, straight from its saved mails
+    """
+    patches = gitq.saved_patches(base)
+    if not patches:
+        pgl.die('Missing patches for %s. Oops!' % (pgl.config['NAMES'][base],))
+    data = ''.join(text for _, text in patches)
+    if mode == 'patch':
+        sys.stdout.write(data)
+        return 0
+
+    gs = gitq.session()
+    proc = gs.popen(['apply', '--numstat' if mode == 'names' else '--stat'],
+        stdin=subprocess.PIPE)
+    out, err = proc.communicate(data)
+    if proc.returncode:
+        sys.stderr.write(err)
+        return 1
+    if mode == 'names':
+        out = ''.join('%s\n' % (line.split('\t', 2)[2],)
+                      for line in out.splitlines())
+    sys.stdout.write(out)
+    return 0
+
 @pgl.main
 def main():
+    ap = argparse.ArgumentParser(description='Show the diff of a patch',
+        prog='git qdiff')
+    ap.add_argument('pname', nargs='?', default=None,
+        help='Patch to show, applied or not (default: the top patch, with '
+             'uncommitted changes)')
+    ap.add_argument('--stat', dest='mode', action='store_const',
+        const='stat', default='patch', help='Show a diffstat')
+    ap.add_argument('--name-only', dest='mode', action='store_const',
+        const='names', help='Only show the names of the files changed')
+    args = gitq.parse_args(ap)
+
     gitq.include_config()
+    gitq.lock_queue()
     gitq.load_series()
 
-    os.execvp('git', ['git', 'diff', '%s~1' % (pgl.config['ACTIVE_PATCH'],)])
+    if args.pname:
+        base = pgl.config['SHAS'].get(args.pname)
+        if base is None:
+            pgl.die('Unknown patch: %s' % (args.pname,))
+        live = False
+    else:
+        if not pgl.config['SERIES']:
+            pgl.die('No patches applied!')
+        base = pgl.config['ACTIVE_PATCH']
+        live = gitq.repo_has_changes(untracked=False)
+
+    modeargs = gitq.DiffCache.MODES[args.mode]
+    if live:
+        # The working copy is part of it and could be different every time,
+        # so there's nothing to cache
+        return run_git(['diff'] + modeargs + ['%s~1' % (base,)])
+
+    info = gitq.patch_info(base)
+    # Keep the entry if it had to be worked out, or the next qdiff would
+    # have to run the whole diff again to find the trees
+    gitq.patch_cache().save(set(pgl.config['NAMES'].itervalues()))
+    if info is None:
+        return show_saved(base, args.mode)
+
+    if sys.stdout.isatty():
+        # Let git page and colour it
+        return run_git(['diff'] + modeargs + [info['base_tree'],
+                                              info['tip_tree']])
+
+    sys.stdout.write(gitq.diff_cache().get(info['base_tree'],
+                                           info['tip_tree'], args.mode))
+    return 0
@@ -0,0 +1,56 @@
+#!/usr/bin/env python
+"""Entry point for every gitq command. Installed as git-q, so commands can
+be run as "git q <command>"; the old git-q<command> names are links to it
+and pick their command from the name they were run as. Only the module for
+the chosen command gets imported.
+"""
+
+import os
+import sys
+
+import pgl
+
+COMMANDS = {
+    'check': 'qcheck',
+    'commit': 'qcommit',
+    'daemon': 'qdaemon',
+    'diff': 'qdiff',
+    'goto': 'qgoto',
+    'graph': 'qgraph',
+    'import': 'qimport',
+    'new': 'qnew',
+    'pack': 'qpack',
+    'patch': 'qpatch',
+    'pop': 'qpop',
+    'push': 'qpush',
+    'rebase': 'qrebase',
+    'refresh': 'qrefresh',
+    'series': 'qseries',
+    'status': 'qstatus',
+}
+
+def usage():
+    sys.stderr.write('usage: git q <command> [<args>]\n\nCommands:\n')
+    for name in sorted(COMMANDS):
+        sys.stderr.write('    %s\n' % (name,))
+
+@pgl.main
+def main():
+    prog = os.path.basename(sys.argv[0])
+    if prog.endswith('.py'):
+        prog = prog[:-3]
+
+    if prog.startswith('git-q') and prog[5:] in COMMANDS:
+        # Run through one of the git-q<command> links
+        name = prog[5:]
+        argv = sys.argv[1:]
+    elif len(sys.argv) > 1 and sys.argv[1] in COMMANDS:
+        name = sys.argv[1]
+        argv = sys.argv[2:]
+    else:
+        usage()
+        return 1
+
+    sys.argv = ['git-q%s' % (name,)] + argv
+    module = __import__(COMMANDS[name])
+    return module.main()
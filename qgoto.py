@@ -0,0 +1,53 @@
+#!/usr/bin/env python
+
+import argparse
+import sys
+
+import gitq
+import pgl
+
+@pgl.main
+def main():
+    ap = argparse.ArgumentParser(
+        description='Push or pop patches until the named patch is on top',
+        prog='git qgoto')
+    ap.add_argument('pname', help='Name of patch')
+    args = gitq.parse_args(ap)
+
+    gitq.include_config()
+    gitq.lock_queue(exclusive=True)
+    gitq.load_series()
+
+    if args.pname not in pgl.config['SHAS']:
+        pgl.die('Unknown patch: %s' % (args.pname,))
+    target = pgl.config['SHAS'][args.pname]
+
+    if gitq.repo_has_changes(untracked=False):
+        pgl.die('Working copy has uncommitted changes. Either qrefresh or '
+                'stash them before continuing.')
+
+    if target in pgl.config['SERIES']:
+        # Pop everything above it in one go
+        count = len(pgl.config['SERIES']) - \
+                pgl.config['SERIES'].index(target) - 1
+        if count:
+            gitq.pop_patches(count)
+        sys.stdout.write('Now at %s\n' % (args.pname,))
+        return 0
+
+    # Push parked patches from the top of the stack down to the target, all
+    # in the object database, with one working copy update at the end
+    i = pgl.config['UNAPPLIED'].index(target)
+    bases = list(reversed(pgl.config['UNAPPLIED'][i:]))
+    names = [pgl.config['NAMES'][base] for base in bases]
+    pushed, failed = gitq.push_patches(bases)
+    for name in names[:len(pushed)]:
+        sys.stdout.write('Applied %s\n' % (name,))
+
+    if failed is not None:
+        pgl.die('%s does not apply cleanly. Use "git qpush" to apply it and '
+                'resolve the conflicts.' % (pgl.config['NAMES'][failed],))
+
+    sys.stdout.write('Now at %s\n' % (args.pname,))
+
+    return 0
@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+
+import argparse
+import sys
+
+import gitq
+import pgl
+
+KINDS = {'hunk': 'same lines', 'file': 'same files'}
+
+def movable(graph, bases):
+    """Return the patches in bases (in stack order, bottom first) that don't
+    touch anything above them, and so could be taken off or moved up on
+    their own
+    """
+    free = []
+    for i, base in enumerate(bases):
+        if not any(other in graph[base] for other in bases[i + 1:]):
+            free.append(base)
+    return free
+
+def write_dot(graph, bases):
+    names = pgl.config['NAMES']
+    sys.stdout.write('graph queue {\n')
+    for base in bases:
+        sys.stdout.write('  "%s";\n' % (names[base],))
+    for i, a in enumerate(bases):
+        for b in bases[i + 1:]:
+            if b in graph[a]:
+                style = 'bold' if graph[a][b] == 'hunk' else 'dashed'
+                sys.stdout.write('  "%s" -- "%s" [style=%s];\n' %
+                    (names[a], names[b], style))
+    sys.stdout.write('}\n')
+
+@pgl.main
+def main():
+    ap = argparse.ArgumentParser(
+        description='Show which patches touch the same files',
+        prog='git qgraph')
+    ap.add_argument('--groups', dest='groups', default=False,
+        action='store_true',
+        help='Show sets of patches that are independent of each other')
+    ap.add_argument('--dot', dest='dot', default=False, action='store_true',
+        help='Write the graph in graphviz format')
+    args = gitq.parse_args(ap)
+
+    gitq.include_config()
+    gitq.lock_queue()
+    if not gitq.queue_exists():
+        pgl.die('There is no git queue for branch %s here!' %
+            (pgl.config['BRANCH'],))
+    gitq.load_series()
+
+    names = pgl.config['NAMES']
+    applied = pgl.config['SERIES']
+    # Bottom of the stack first, the way they'd be pushed
+    unapplied = list(reversed(pgl.config['UNAPPLIED']))
+    bases = applied + unapplied
+    if not bases:
+        pgl.die('No patches for this branch!')
+
+    graph = gitq.conflict_graph(bases)
+
+    if args.dot:
+        write_dot(graph, bases)
+        return 0
+
+    if args.groups:
+        for group in gitq.independent_groups(graph, bases):
+            sys.stdout.write('%s\n' % (' '.join(names[b] for b in group),))
+        return 0
+
+    for base in bases:
+        status = 'A' if base in applied else 'U'
+        others = ['%s (%s)' % (names[o], KINDS[graph[base][o]])
+                  for o in bases if o in graph[base]]
+        sys.stdout.write('%s %s: %s\n' % (status, names[base],
+            ', '.join(others) or 'independent'))
+
+    if applied:
+        sys.stdout.write('Can be popped on its own: %s\n' %
+            (' '.join(names[b] for b in movable(graph, applied)) or 'none',))
+    if unapplied:
+        # A parked patch can be pushed early if nothing below it touches
+        # the same files
+        free = movable(graph, list(reversed(unapplied)))
+        sys.stdout.write('Can be pushed on its own: %s\n' %
+            (' '.join(names[b] for b in unapplied if b in free) or 'none',))
+
+    return 0
@@ -0,0 +1,311 @@
+#!/usr/bin/env python
+
+import argparse
+import os
+import re
+import subprocess
+import sys
+
+import gitq
+import pgl
+
+fromre = re.compile('^From \\S+ +\\w{3} \\w{3} +\\d+ ')
+subjre = re.compile('^(\\[[^\\]]*\\]\\s*)+')
+
+def split_mbox(f):
+    """Yield the messages in an mbox file, one string at a time
+    """
+    msg = []
+    prev = '\n'
+    for line in f:
+        if fromre.match(line) and prev in ('\n', '\r\n') and msg:
+            yield ''.join(msg)
+            msg = []
+        msg.append(line)
+        prev = line
+    if msg:
+        yield ''.join(msg)
+
+def diff_start(lines, start):
+    """Return the index of the first line of the diff in lines, looking from
+    start, or None
+    """
+    for i in range(start, len(lines)):
+        line = lines[i]
+        if line.startswith('diff ') or line.startswith('Index: '):
+            return i
+        if line.startswith('--- ') and i + 1 < len(lines) and \
+           lines[i + 1].startswith('+++ '):
+            return i
+    return None
+
+def split_body(body):
+    """Split the text after the headers into (message, diff)
+    """
+    lines = body.splitlines(True)
+    start = diff_start(lines, 0)
+    if start is None:
+        return body, ''
+    # format-patch puts a --- line and a diffstat between the message and
+    # the diff
+    end = start
+    for i in range(start):
+        if lines[i].rstrip('\r\n') == '---':
+            end = i
+            break
+    return ''.join(lines[:end]), ''.join(lines[start:])
+
+def parse_mail(text):
+    """Parse a patch mail, like format-patch makes
+    """
+    import email
+    import email.header
+    import email.utils
+
+    msg = email.message_from_string(text)
+    def header(key):
+        val = msg.get(key, '')
+        parts = []
+        for part, charset in email.header.decode_header(val):
+            if charset:
+                part = part.decode(charset, 'replace').encode('utf-8')
+            parts.append(part)
+        return ' '.join(parts).replace('\n', ' ')
+
+    name, addr = email.utils.parseaddr(header('from'))
+    date = None
+    parsed = email.utils.parsedate_tz(msg.get('date', ''))
+    if parsed:
+        offset = parsed[9] or 0
+        date = '%d %s%02d%02d' % (email.utils.mktime_tz(parsed),
+            '-' if offset < 0 else '+', abs(offset) // 3600,
+            abs(offset) % 3600 // 60)
+
+    payload = msg.get_payload(decode=True)
+    if payload is None:
+        # Multipart, take the first text part
+        for part in msg.walk():
+            if part.get_content_maintype() == 'text':
+                payload = part.get_payload(decode=True)
+                break
+    message, diff = split_body(payload or '')
+    subject = subjre.sub('', header('subject')).strip()
+    message = message.strip()
+    if message:
+        subject = '%s\n\n%s' % (subject, message)
+    return {'author': name, 'email': addr, 'date': date,
+            'message': subject, 'diff': diff}
+
+def parse_hg(text):
+    """Parse an hg export or MQ patch, or a bare diff
+    """
+    author = date = None
+    header, sep, body = text.partition('\n\n')
+    lines = text.splitlines(True)
+    start = 0
+    if lines and lines[0].startswith('# HG changeset patch'):
+        for start, line in enumerate(lines[1:], 1):
+            if not line.startswith('# '):
+                break
+            key, _, val = line[2:].partition(' ')
+            if key == 'User':
+                author = val.strip()
+            elif key == 'Date':
+                ts, _, tz = val.strip().partition(' ')
+                # hg keeps the offset in seconds west of UTC
+                tz = -int(tz or 0)
+                date = '%s %s%02d%02d' % (ts, '-' if tz < 0 else '+',
+                    abs(tz) // 3600, abs(tz) % 3600 // 60)
+    elif sep and header.startswith('From: ') and '\n' not in header:
+        author = header[len('From: '):].strip()
+        start = 2 + header.count('\n')
+    message, diff = split_body(''.join(lines[start:]))
+
+    name = addr = None
+    if author:
+        import email.utils
+        name, addr = email.utils.parseaddr(author)
+    return {'author': name, 'email': addr, 'date': date,
+            'message': message.strip(), 'diff': diff}
+
+def parse(item):
+    """Parse one patch. item is (name hint, contents).
+    """
+    hint, text = item
+    if text.startswith('From ') and not text.startswith('From: ') or \
+       re.match('^(From|Subject|Date): ', text) and \
+       re.search('^Subject: ', text, re.M) and '\n\n' in text:
+        info = parse_mail(text)
+    else:
+        info = parse_hg(text)
+    info['hint'] = hint
+    if not info['message']:
+        info['message'] = hint
+    return info
+
+def parse_all(items):
+    """Parse every patch, spread over a process pool
+    """
+    if len(items) < 2:
+        return [parse(item) for item in items]
+
+    import multiprocessing
+    pool = multiprocessing.Pool(min(len(items), multiprocessing.cpu_count()))
+    try:
+        return pool.map(parse, items)
+    finally:
+        pool.close()
+        pool.join()
+
+def read_source(path):
+    """Return [(name hint, contents)] for everything in path: an mbox, a
+    single patch, an hg MQ patches directory (with a series file) or a
+    directory of patches
+    """
+    items = []
+    if os.path.isdir(path):
+        series = os.path.join(path, 'series')
+        if os.path.exists(series):
+            with file(series) as f:
+                names = []
+                for line in f:
+                    # Drop comments and guards
+                    line = line.split('#', 1)[0].strip()
+                    if line:
+                        names.append(line)
+        else:
+            names = sorted(n for n in os.listdir(path)
+                           if n.endswith('.patch') or n.endswith('.diff'))
+        for name in names:
+            with file(os.path.join(path, name)) as f:
+                items.append((name, f.read()))
+        return items
+
+    with file(path) as f:
+        first = f.readline()
+        f.seek(0)
+        if fromre.match(first):
+            for msg in split_mbox(f):
+                items.append((None, msg))
+        else:
+            items.append((os.path.basename(path), f.read()))
+    return items
+
+def patch_name(info, taken):
+    """Come up with a name for an imported patch that's valid and not used
+    """
+    hint = info['hint']
+    if hint:
+        hint = os.path.basename(hint)
+        hint = re.sub('\\.(patch|diff)$', '', hint)
+        hint = re.sub('^\\d{4}-', '', hint)
+    else:
+        hint = info['message'].split('\n', 1)[0]
+    name = re.sub('[^A-Za-z0-9._+-]+', '-', hint).strip('-.')[:50].strip('-.')
+    name = name or 'patch'
+    if not gitq.valid_patch_name(name):
+        name = 'patch'
+    base, n = name, 1
+    while name in taken:
+        n += 1
+        name = '%s-%d' % (base, n)
+    taken.add(name)
+    return name
+
+def build_commits(infos, onto):
+    """Turn the parsed patches into a chain of commits on top of onto,
+    applying them to a private index. Returns the list of new commits.
+    """
+    gs = gitq.session()
+    env = gitq.temp_index('import')
+    if gs.run(['read-tree', onto], env=env)[0]:
+        pgl.die('Failed to read tree for %s' % (onto,))
+
+    # Patches that don't say who wrote them get our identity, the way git
+    # commit would
+    ident = gitq.split_ident(gitq.own_ident())
+    commits = []
+    parent = onto
+    for info in infos:
+        if info['diff']:
+            proc = gs.popen(['apply', '--cached'], stdin=subprocess.PIPE,
+                env=env)
+            _, err = proc.communicate(info['diff'])
+            if proc.returncode:
+                sys.stderr.write(err)
+                pgl.die('%s does not apply' % (info['name'],))
+        rval, tree = gs.run(['write-tree'], env=env)
+        if rval:
+            pgl.die('Failed to write tree')
+        name = info['author'] or ident[0]
+        addr = info['email'] or ident[1]
+        date = info['date'] or ident[2]
+        message = info['message'].rstrip('\n') + '\n'
+        parent = gitq.commit_tree(tree.strip(), [parent],
+            '%s <%s> %s' % (name, addr, date), message)
+        commits.append(parent)
+    return commits
+
+@pgl.main
+def main():
+    ap = argparse.ArgumentParser(
+        description='Import patches from mboxes, files or directories',
+        prog='git qimport')
+    ap.add_argument('sources', nargs='+',
+        help='mbox, patch file, hg MQ patches directory or patch directory')
+    ap.add_argument('--push', dest='push', default=False, action='store_true',
+        help='Apply the imported patches instead of leaving them popped')
+    args = gitq.parse_args(ap)
+
+    gitq.include_config()
+    gitq.lock_queue(exclusive=True)
+    gitq.init_queue()
+    gitq.load_series()
+
+    items = []
+    for source in args.sources:
+        if not os.path.exists(source):
+            pgl.die('No such file or directory: %s' % (source,))
+        items.extend(read_source(source))
+    if not items:
+        pgl.die('Nothing to import!')
+
+    if args.push:
+        if gitq.repo_has_changes(untracked=False):
+            pgl.die('Working copy has uncommitted changes. Either qrefresh '
+                    'or stash them before continuing.')
+
+    infos = parse_all(items)
+    taken = set(pgl.config['SHAS'])
+    for info in infos:
+        info['name'] = patch_name(info, taken)
+
+    # Everything happens in the object database; the working copy is only
+    # touched once at the end, and only with --push
+    commits = build_commits(infos, pgl.config['HEAD_SHA'])
+    for info, commit in zip(infos, commits):
+        if commit in pgl.config['NAMES']:
+            # The very same commit, so the very same patch
+            pgl.die('%s is already in the queue as %s' %
+                (info['name'], pgl.config['NAMES'][commit]))
+    for info, commit in zip(infos, commits):
+        pgl.config['NAMES'][commit] = info['name']
+        pgl.config['SHAS'][info['name']] = commit
+
+    if args.push:
+        if not gitq.move_head(commits[-1]):
+            pgl.die('Failed to update working copy')
+        pgl.config['SERIES'].extend(commits)
+        pgl.config['ACTIVE_PATCH'] = commits[-1]
+    else:
+        # Parked, with the first one on top of the stack for qpush
+        if not gitq.update_refs([(gitq.patch_ref(info['name']), commit)
+                                 for info, commit in zip(infos, commits)]):
+            pgl.die('Failed to save patches')
+        pgl.config['UNAPPLIED'].extend(reversed(commits))
+    gitq.write_series()
+    gitq.update_patch_cache(commits)
+
+    sys.stdout.write('Imported %d patches\n' % (len(commits),))
+
+    return 0
@@ -1,7 +1,6 @@
 #!/usr/bin/env python
 
 import argparse
-import os
 import sys
 
 import gitq
@@ -16,41 +15,58 @@ def main():
         action='store_true', default=False)
     ap.add_argument('-m', dest='commitmsg', help='Commit message for patch',
         default=None)
+    ap.add_argument('--from-diff', dest='fromdiff', metavar='FILE',
+        default=None,
+        help='Make the patch from a diff (- for stdin) without touching the '
+             'working copy')
     # TODO - handle different username/email
-    args = ap.parse_args()
+    args = gitq.parse_args(ap)
+
+    if args.fromdiff and args.all:
+        pgl.die('-a and --from-diff do not go together')
 
     # Make sure we have all the config we need
     gitq.include_config()
+    gitq.lock_queue(exclusive=True)
 
     # Make sure our queue directory is setup
-    if not os.path.exists(pgl.config['QUEUE_SERIES']):
-        if not os.path.exists(pgl.config['BRANCH_QUEUE']):
-            if not os.path.exists(pgl.config['QUEUES']):
-                os.mkdir(pgl.config['QUEUES'])
-            os.mkdir(pgl.config['BRANCH_QUEUE'])
-        file(pgl.config['QUEUE_SERIES'], 'w').close()
-    if not os.path.exists(pgl.config['UNAPPLIED_PATCHES']):
-        file(pgl.config['UNAPPLIED_PATCHES'], 'w').close()
-    if not os.path.exists(pgl.config['SHA_NAME_MAP']):
-        file(pgl.config['SHA_NAME_MAP'], 'w').close()
+    gitq.init_queue()
 
     # Make sure we don't already have a patch named like the one we want
     gitq.load_series()
+    if args.pname in pgl.config['SHAS']:
+        pgl.die('There is already a patch named %s' % (args.pname,))
+    if not gitq.valid_patch_name(args.pname):
+        pgl.die('%s is not a valid patch name' % (args.pname,))
 
-    # Commit outstanding changes
-    if not gitq.update_patch(commit_all=args.all, commitmsg=args.commitmsg,
-                             new=True):
-        pgl.die('Nothing to make a new patch from!')
+    if args.fromdiff:
+        # Build the commit in a private index and just move the branch
+        head = pgl.config['HEAD_SHA']
+        tree = gitq.diff_to_tree(gitq.read_diff(args.fromdiff), head)
+        if tree is None:
+            pgl.die('The diff does not apply to %s' % (pgl.config['BRANCH'],))
+        if tree == gitq.session().rev_parse('%s^{tree}' % (head,)):
+            pgl.die('Nothing to make a new patch from!')
+        patchbase = gitq.commit_tree(tree, [head], gitq.own_ident(),
+            (args.commitmsg or args.pname).rstrip('\n') + '\n')
+        if not gitq.set_branch_tip(patchbase, 'gitq: new %s' % (args.pname,)):
+            pgl.die('Failed to update %s' % (pgl.config['BRANCH'],))
+    else:
+        # Commit outstanding changes
+        if not gitq.update_patch(commit_all=args.all,
+                                 commitmsg=args.commitmsg, new=True):
+            pgl.die('Nothing to make a new patch from!')
 
-    # Do this again here to figure out the base of our new patch
-    gitq.include_config()
-    patchbase = pgl.config['HEAD_SHA']
+        # Do this again here to figure out the base of our new patch
+        gitq.include_config()
+        patchbase = pgl.config['HEAD_SHA']
 
     # Update our stored idea of the patch series on disk
     pgl.config['SERIES'].append(patchbase)
     pgl.config['ACTIVE_PATCH'] = patchbase
     pgl.config['NAMES'][patchbase] = args.pname
     gitq.write_series()
+    gitq.update_patch_cache([patchbase])
 
     # Done!
     sys.stdout.write('Started new patch on branch %s\n' %
@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+
+import argparse
+import os
+import re
+import sys
+
+import gitq
+import pgl
+
+SHA = re.compile('^[0-9a-f]{40}$')
+
+def pack_queue(qdir):
+    """Move the patch directories older gitq left in qdir into its pack.
+    Returns how many patches were packed.
+    """
+    import shutil
+
+    branch = None
+    if qdir == pgl.config['BRANCH_QUEUE']:
+        branch = pgl.config['BRANCH']
+    store = gitq.QueueStore(qdir, branch)
+    if not store.exists():
+        return 0
+    unapplied = set(store.state['unapplied'])
+
+    # Leave alone a patch that qpush is in the middle of applying
+    busy = []
+    for applying in (os.path.join(qdir, 'applying_dir'),
+                     os.path.join(pgl.config['QUEUES'], 'applying_dir')):
+        if os.path.exists(applying):
+            with file(applying) as f:
+                busy.append(f.readline().strip())
+
+    patches = {}
+    for entry in sorted(os.listdir(qdir)):
+        patchdir = os.path.join(qdir, entry)
+        if not SHA.match(entry) or entry not in unapplied or \
+           not os.path.isdir(patchdir) or patchdir in busy:
+            continue
+        files = []
+        for fname in sorted(os.listdir(patchdir)):
+            if fname.endswith('.patch'):
+                with file(os.path.join(patchdir, fname)) as f:
+                    files.append((fname, f.read()))
+        if files:
+            patches[entry] = files
+
+    if not patches:
+        return 0
+
+    gitq.PatchPack(qdir).add(patches)
+    for base in patches:
+        shutil.rmtree(os.path.join(qdir, base))
+    return len(patches)
+
+@pgl.main
+def main():
+    ap = argparse.ArgumentParser(
+        description='Pack patches popped by older versions of gitq',
+        prog='git qpack')
+    ap.add_argument('-a', '--all', dest='all', default=False,
+        action='store_true', help='Pack the queues of every branch')
+    args = gitq.parse_args(ap)
+
+    gitq.include_config()
+
+    if args.all:
+        qdirs = []
+        if os.path.exists(pgl.config['QUEUES']):
+            qdirs = [os.path.join(pgl.config['QUEUES'], d)
+                     for d in sorted(os.listdir(pgl.config['QUEUES']))]
+        qdirs = [d for d in qdirs if os.path.isdir(d)]
+    else:
+        if not gitq.queue_exists():
+            pgl.die('There is no git queue for branch %s here!' %
+                (pgl.config['BRANCH'],))
+        qdirs = [pgl.config['BRANCH_QUEUE']]
+
+    total = 0
+    for qdir in qdirs:
+        lock = gitq.QueueLock(qdir)
+        lock.acquire(exclusive=True)
+        try:
+            total += pack_queue(qdir)
+        finally:
+            lock.release()
+    sys.stdout.write('Packed %d patches\n' % (total,))
+
+    return 0
@@ -1,34 +1,129 @@
 #!/usr/bin/env python
 
 import argparse
-import copy
-import email
-import email.iterators
 import os
 import re
-import subprocess
 import sys
 
 import gitq
 import pgl
 
 subjre = re.compile('\\[[^\\]]+\\] ')
+fromre = re.compile('^From [0-9a-f]{40} ')
 
 def hgify(f):
     """Given a file-like object that is the output of git format-patch, turn
     that into the kind of patch that hg expects with its special headers and
-    such.
+    such. This streams, only the headers are ever held in memory, so it's fine
+    to hand it enormous patches.
     """
-    msg = email.message_from_file(f)
-    body = email.iterators.body_line_iterator(msg)
-    yield 'From: %s\n' % msg['From']
+    headers = {}
+    last = None
+    for line in f:
+        if line in ('\n', '\r\n'):
+            break
+        if line.startswith('From ') and last is None:
+            # mbox separator line
+            continue
+        if line[0] in ' \t' and last is not None:
+            # Folded header
+            headers[last] += '\n' + line.rstrip('\r\n')
+            continue
+        key, _, val = line.partition(':')
+        last = key.strip().lower()
+        headers[last] = val.strip()
+
+    yield 'From: %s\n' % headers.get('from')
     yield '\n'
-    yield '%s\n' % subjre.sub('', msg['Subject']).replace('\n', ' ')
-    for line in body:
+    yield '%s\n' % subjre.sub('', headers.get('subject', '')).replace('\n', ' ')
+    for line in f:
         if line.startswith('index '):
             continue
         yield line
 
+def hgify_file(fname):
+    """Convert the patch in fname to an hg-style patch in place
+    """
+    # Write out to a temporary file
+    fname_out = '%s.temp' % (fname,)
+    with file(fname) as fin:
+        with file(fname_out, 'w') as fout:
+            for line in hgify(fin):
+                fout.write(line)
+
+    # And move the temp file into place
+    os.rename(fname_out, fname)
+    return fname
+
+def hgify_files(fnames):
+    """Convert a list of patch files to hg-style patches, one per worker
+    process. Returns the converted file names in the same order they were
+    given.
+    """
+    if len(fnames) < 2:
+        return [hgify_file(fname) for fname in fnames]
+
+    import multiprocessing
+    pool = multiprocessing.Pool(min(len(fnames), multiprocessing.cpu_count()))
+    try:
+        return pool.map(hgify_file, fnames)
+    finally:
+        pool.close()
+        pool.join()
+
+def split_mbox(f):
+    """Split the mbox format-patch --stdout writes into messages as it comes
+    in, yielding (separator line, iterator over the rest of the message).
+    Each message has to be read to the end before asking for the next one.
+    """
+    lines = iter(f.readline, '')
+    line = next(lines, None)
+    while line is not None:
+        following = [None]
+        def message():
+            for l in lines:
+                if fromre.match(l):
+                    following[0] = l
+                    return
+                yield l
+        yield line, message()
+        line = following[0]
+
+def stream_patches(gfpargs, hg):
+    """Run format-patch --stdout and copy the mbox to our stdout as it's
+    made, converting each message if hg
+    """
+    import errno
+
+    gs = gitq.session()
+    gfp = gs.popen(gfpargs + ['--stdout'], stderr=None)
+    out = sys.stdout
+    try:
+        if hg:
+            for sep, message in split_mbox(gfp.stdout):
+                # Keep the separators so the other end can still split it up
+                out.write(sep)
+                for line in hgify(message):
+                    out.write(line)
+                out.flush()
+        else:
+            fd = gfp.stdout.fileno()
+            while True:
+                data = os.read(fd, 65536)
+                if not data:
+                    break
+                out.write(data)
+                out.flush()
+    except IOError as e:
+        if e.errno != errno.EPIPE:
+            raise
+        # Whoever was reading has gone away, which is their business
+        gfp.kill()
+        gfp.wait()
+        return 0
+    gfp.stdout.close()
+    return gfp.wait()
+
 @pgl.main
 def main():
     ap = argparse.ArgumentParser(
@@ -37,73 +132,48 @@ def main():
         action='store_true', default=False)
     ap.add_argument('-o', dest='outdir', help='Directory to write patches to',
         default='.')
+    ap.add_argument('--stdout', dest='stdout',
+        help='Write the series to stdout as one mbox instead of to files',
+        action='store_true', default=False)
     ap.add_argument('--nocleanup', dest='nocleanup',
-        help='Do not reset to QPATCH_HEAD after creating patches',
-        default=False, action='store_true')
-    args = ap.parse_args()
-
-    if gitq.repo_has_changes():
-        pgl.die('Working copy has uncommitted changes. Either stash or commit '
-                'them to continue')
+        help='Ignored, qpatch no longer moves HEAD', default=False,
+        action='store_true')
+    args = gitq.parse_args(ap)
 
     gitq.include_config()
+    gitq.lock_queue()
     gitq.load_series()
+    gs = gitq.session()
+
+    if not pgl.config['SERIES']:
+        pgl.die('No patches for this branch!')
 
-    # Figure out our current HEAD so we can reset to it
-    grp = subprocess.Popen(['git', 'rev-parse', '--verify', 'HEAD'],
-        stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    lines = grp.stdout.readlines()
-    if grp.wait():
-        pgl.die('Could not figure out HEAD')
-    orig_head = lines[0].strip()
-    if not orig_head:
-        pgl.die('Could not figure out HEAD sha')
-
-    # Set up a symbolic ref so we can get back to where we were
-    gsr = subprocess.Popen(['git', 'symbolic-ref', 'QPATCH_HEAD', orig_head],
-        stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    gsr.wait()
-
-    # Squash down our patches into a sane set of patches
+    # Squash down our patches into a sane set of patches. This only writes
+    # new commit objects, HEAD and the working copy are left alone, so it's
+    # safe to run while other work is going on in the checkout.
     base = '%s~1' % (pgl.config['SERIES'][0],)
-    grenv = copy.deepcopy(os.environ)
-    grenv['GIT_EDITOR'] = 'true'
-    gr = subprocess.Popen(['git', 'rebase', '-i', '--autosquash', base],
-        stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=grenv)
-    gr.wait()
+    squashed = gitq.squash_series()
 
     # Use format-patch to make the patches
-    gfpargs = ['git', 'format-patch', '-n']
+    gfpargs = ['format-patch', '-n']
     if args.hg:
         gfpargs.extend(['--no-signature', '--no-stat'])
+    gfpargs.append('%s..%s' % (base, squashed[-1][1]))
+
+    if args.stdout:
+        if stream_patches(gfpargs, args.hg):
+            pgl.die('Failed to write patches')
+        return 0
+
     if args.outdir != '.':
         gfpargs.extend(['-o', args.outdir])
-    gfpargs.append(base)
-    gfp = subprocess.Popen(gfpargs, stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE)
-    patches = gfp.stdout.readlines()
-    gfp.wait()
+    rval, out = gs.run(gfpargs)
+    if rval:
+        pgl.die('Failed to write patches')
+    patches = out.splitlines()
 
     # Make into hg-style patches if necessary
     if args.hg:
-        for patch in patches:
-            # Write out to a temporary file
-            fname = patch.strip()
-            fname_out = '%s.temp' % (fname,)
-            fin = file(fname)
-            fout = file(fname_out, 'w')
-            fout.writelines(hgify(fin))
-            fin.close()
-            fout.close()
-
-            # And move the temp file into place
-            os.unlink(fname)
-            os.rename(fname_out, fname)
-
-    if not args.nocleanup:
-        # Finally, go back to our original state
-        gc = subprocess.Popen(['git', 'reset', '--hard', orig_head],
-            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        gc.wait()
+        hgify_files([patch.strip() for patch in patches])
 
     return 0
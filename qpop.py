@@ -1,16 +1,21 @@
 #!/usr/bin/env python
 
-import os
-import subprocess
-import sys
+import argparse
 
 import gitq
 import pgl
 
 @pgl.main
 def main():
+    ap = argparse.ArgumentParser(description='Unapply the top patch',
+        prog='git qpop')
+    ap.add_argument('-a', '--all', dest='all', help='Unapply all patches',
+        default=False, action='store_true')
+    args = gitq.parse_args(ap)
+
     # Make sure we have all the config we need
     gitq.include_config()
+    gitq.lock_queue(exclusive=True)
 
     gitq.load_series()
 
@@ -20,32 +25,15 @@ def main():
         pgl.die('No patches for this branch!')
 
     # Make sure we have no uncommitted changes
-    if gitq.repo_has_changes():
+    if gitq.repo_has_changes(untracked=False):
         pgl.die('Working copy has uncommitted stages. Either qrefresh or '
                 'stash them before continuing.')
 
-    # Write the patch to disk using format-patch
-    patchdir = os.path.join(pgl.config['BRANCH_QUEUE'], patchbase)
-    os.mkdir(patchdir)
-    gfp = subprocess.Popen(['git', 'format-patch', '-o', patchdir,
-                            '--no-signature', '-n', '--no-stat',
-                            '%s~1' % (patchbase,)],
-        stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    if gfp.wait():
-        pgl.die('Failed to save patch')
-
-    # Reset our working copy to before the patch
-    reset_point = '%s~1' % (patchbase,)
-    gitreset = subprocess.Popen(['git', 'reset', '--hard', reset_point],
-        stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    if gitreset.wait():
-        shutil.rmtree(patchdir)
-        pgl.die('Failed to pop patch')
-
-    # Move our now-saved patch into the unapplied list and save new state
-    pgl.config['SERIES'] = pgl.config['SERIES'][:-1]
-    pgl.config['UNAPPLIED'].append(patchbase)
-
-    gitq.write_series()
+    # Park the patches under refs/queue, reset our working copy to before
+    # them, and move them into the unapplied list
+    count = 1
+    if args.all:
+        count = len(pgl.config['SERIES'])
+    gitq.pop_patches(count)
 
     return 0
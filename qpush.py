@@ -1,36 +1,74 @@
 #!/usr/bin/env python
 
 import argparse
-import glob
 import os
-import shutil
-import subprocess
 import sys
 
 import gitq
 import pgl
 
-def do_cleanup_and_fix_series(patchdir_ref, patchdir, apply_sha, apply_name):
+def applying_ref():
+    """Where we note the patch a paused qpush is applying. It's kept per
+    branch, so a paused qpush on one branch doesn't get in the way of
+    another.
+    """
+    ref = os.path.join(pgl.config['BRANCH_QUEUE'], 'applying_dir')
+    old = os.path.join(pgl.config['QUEUES'], 'applying_dir')
+    if not os.path.exists(ref) and os.path.exists(old):
+        # Left by an older gitq
+        return old
+    return ref
+
+def abort_cleanup():
+    """Forget about the patch an aborted qpush was applying. The mails we
+    wrote for it go too, unless they're the only copy (a patch saved by an
+    older gitq that isn't in the pack).
+    """
+    import shutil
+
+    patchdir_ref = applying_ref()
+    if not os.path.exists(patchdir_ref):
+        return
+    with file(patchdir_ref) as f:
+        patchdir = f.readline().strip()
+    apply_sha = os.path.basename(patchdir)
+    name = pgl.config['NAMES'].get(apply_sha)
+    if os.path.isdir(patchdir) and \
+       (apply_sha in gitq.patch_pack() or
+        name and gitq.session().rev_parse(gitq.patch_ref(name))):
+        shutil.rmtree(patchdir)
+    os.unlink(patchdir_ref)
+
+def do_cleanup_and_fix_series(patchdir_ref, patchdir, orig_head, apply_sha,
+                              apply_name):
     """Performs cleanup and re-writing of metadata after a qpush succeeds
     """
+    import shutil
+
     # Remove cache of patchdir
     os.unlink(patchdir_ref)
 
-    # Remove saved patches directory
+    # Remove saved patches directory and the parked copy of the patch
     shutil.rmtree(patchdir)
+    gitq.update_refs([(gitq.patch_ref(apply_name), None)])
+    gitq.patch_pack().remove(apply_sha)
 
-    # Put our reapplied patch in the series, and save to disk
+    # Put our reapplied patch in the series, and save to disk. The base of
+    # the patch is the first commit git-am made.
     gitq.include_config() # Re-read HEAD sha
-    pgl.config['SERIES'].append(pgl.config['HEAD_SHA'])
+    newbase = pgl.config['HEAD_SHA']
+    if orig_head:
+        newbase = gitq.session().lines(['rev-list', '--reverse',
+            '%s..%s' % (orig_head, pgl.config['HEAD_SHA'])])[0]
+    pgl.config['SERIES'].append(newbase)
     pgl.config['UNAPPLIED'].remove(apply_sha)
 
     # Now that we may (or may not) have a new base sha for this patch,
     # update that info, too
-    pgl.config['SHAS'][apply_name] = pgl.config['HEAD_SHA']
-    del pgl.config['NAMES'][apply_sha]
-    pgl.config['NAMES'][pgl.config['HEAD_SHA']] = apply_name
+    gitq.rename_patch_base(apply_sha, newbase)
 
     gitq.write_series()
+    gitq.update_patch_cache([newbase])
 
 def check_am_and_maybe_die(gitam):
     """Check the status of our git-am subprocess and die appropriately if it
@@ -52,6 +90,55 @@ def check_am_and_maybe_die(gitam):
         sys.stdout.write('To restore the original branch and stop pushing run "git qpush --abort"\n')
         sys.exit(1)
 
+def am_patch(apply_sha, apply_name):
+    """Apply a parked patch with git-am, so that conflicts can be sorted out
+    in the working copy. Patches saved by older versions of gitq are already
+    on disk (or in the queue's pack), otherwise we write out the parked patch
+    first.
+    """
+    import glob
+    import shutil
+
+    gs = gitq.session()
+
+    patchdir = os.path.join(pgl.config['BRANCH_QUEUE'], apply_sha)
+    tip = gs.rev_parse(gitq.patch_ref(apply_name))
+    if tip is not None and os.path.exists(patchdir):
+        # Mails left from an earlier attempt; the ref is what's current
+        shutil.rmtree(patchdir)
+    if not os.path.exists(patchdir) and apply_sha in gitq.patch_pack():
+        os.mkdir(patchdir)
+        for fname, data in gitq.patch_pack().read(apply_sha):
+            with file(os.path.join(patchdir, fname), 'w') as f:
+                f.write(data)
+    elif not os.path.exists(patchdir):
+        if tip is None:
+            pgl.die('Missing patch for %s. Oops!' % (apply_name,))
+        os.mkdir(patchdir)
+        rval, _ = gs.run(['format-patch', '-o', patchdir, '--no-signature',
+                          '-n', '--no-stat', '%s~1..%s' % (apply_sha, tip)])
+        if rval:
+            shutil.rmtree(patchdir)
+            pgl.die('Failed to write out %s' % (apply_name,))
+
+    patches = sorted(glob.glob(os.path.join(patchdir, '*.patch')))
+    if not patches:
+        pgl.die('Missing patches for %s. Oops!' % (apply_name,))
+
+    # Save our patchdir off for later use
+    patchdir_ref = os.path.join(pgl.config['BRANCH_QUEUE'], 'applying_dir')
+    with file(patchdir_ref, 'w') as f:
+        f.write('%s\n%s\n' % (patchdir, pgl.config['HEAD_SHA']))
+
+    # Re-apply the patches
+    gitamargs = ['am', '--reject']
+    gitamargs.extend(patches)
+    gitam = gs.popen(gitamargs)
+    check_am_and_maybe_die(gitam)
+
+    do_cleanup_and_fix_series(patchdir_ref, patchdir, pgl.config['HEAD_SHA'],
+                              apply_sha, apply_name)
+
 @pgl.main
 def main():
     ap = argparse.ArgumentParser(description='Apply a popped patch',
@@ -59,48 +146,61 @@ def main():
     ap.add_argument('pname', help='Name of patch', default=None, nargs='?')
     ap.add_argument('-i', dest='interactive', help='Choose patch interactively',
         default=False, action='store_true')
+    ap.add_argument('-a', '--all', dest='all', help='Apply all popped patches',
+        default=False, action='store_true')
+    ap.add_argument('--check', dest='check',
+        help="Don't push anything unless every patch applies cleanly",
+        default=False, action='store_true')
     ap.add_argument('--resolved', dest='resolved', help='Continue paused qpush',
         default=False, action='store_true')
     ap.add_argument('--abort', dest='abort', help='Abort paused qpush',
         default=False, action='store_true')
-    args = ap.parse_args()
+    args = gitq.parse_args(ap)
 
     # Make sure we have all the config we need
     gitq.include_config()
+    gitq.lock_queue(exclusive=True)
     gitq.load_series()
+    gs = gitq.session()
 
     if args.abort:
-        gitam = subprocess.Popen(['git', 'am', '--abort'])
-        return gitam.wait()
+        rval = gs.call(['am', '--abort'])
+        abort_cleanup()
+        return rval
 
     if args.resolved:
-        gitam = subprocess.Popen(['git', 'am', '--resolved', '--reject'],
-            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        gitam = gs.popen(['am', '--resolved', '--reject'])
         check_am_and_maybe_die(gitam)
 
-        patchdir_ref = os.path.join(pgl.config['QUEUES'], 'applying_dir')
+        patchdir_ref = applying_ref()
         patchdir = None
         with file(patchdir_ref) as f:
-            patchdir = f.read()
+            lines = f.read().split('\n')
+        patchdir = lines[0]
+        orig_head = lines[1] if len(lines) > 1 and lines[1] else None
 
         apply_sha = os.path.split(patchdir)[1]
         apply_name = pgl.config['NAMES'][apply_sha]
 
-        do_cleanup_and_fix_series(patchdir_ref, patchdir, apply_sha, apply_name)
+        do_cleanup_and_fix_series(patchdir_ref, patchdir, orig_head, apply_sha,
+                                  apply_name)
 
         return 0
 
     # Make sure we have no uncommitted changes
-    if gitq.repo_has_changes():
+    if gitq.repo_has_changes(untracked=False):
         pgl.die('Working directory has uncommitted changes. Either qrefresh '
                 'or stash them before continuing.')
 
     if not pgl.config['UNAPPLIED']:
         pgl.die('No patches for this branch!')
 
-    # Figure out what patch to apply if they didn't specify on the command line
+    # Figure out what patch to apply if they didn't specify on the command line.
+    # Parked patches are a stack, so --all takes them from the top down.
     apply_sha, apply_name = None, None
-    if args.interactive:
+    if args.all:
+        bases = list(reversed(pgl.config['UNAPPLIED']))
+    elif args.interactive:
         while apply_sha is None:
             sys.stdout.write('Choose a patch to apply:\n')
             for i, sha in enumerate(pgl.config['UNAPPLIED']):
@@ -109,7 +209,7 @@ def main():
             choice = raw_input('> ')
             try:
                 if 0 < int(choice) <= len(pgl.config['UNAPPLIED']):
-                    apply_sha = pgl.config['UNAPPLIED'][choice - 1]
+                    apply_sha = pgl.config['UNAPPLIED'][int(choice) - 1]
                     apply_name = pgl.config['NAMES'][apply_sha]
             except ValueError:
                 pass
@@ -118,31 +218,45 @@ def main():
             pgl.die('Unknown patch: %s' % (args.pname,))
         apply_name = args.pname
         apply_sha = pgl.config['SHAS'][args.pname]
+        if apply_sha not in pgl.config['UNAPPLIED']:
+            pgl.die('%s is already applied' % (args.pname,))
+        # Pushing out of order only works if the patches we skip over don't
+        # touch the same files
+        skipped = pgl.config['UNAPPLIED'][
+            pgl.config['UNAPPLIED'].index(apply_sha) + 1:]
+        if skipped:
+            graph = gitq.conflict_graph(skipped + [apply_sha])
+            for other in skipped:
+                if other in graph[apply_sha]:
+                    pgl.warn('%s touches the same files as %s, which comes '
+                             'before it' % (apply_name,
+                                            pgl.config['NAMES'][other]))
     else:
         apply_sha = pgl.config['UNAPPLIED'][-1]
         apply_name = pgl.config['NAMES'][apply_sha]
 
-    # Get the list of patches to apply using git-am
-    patchdir = os.path.join(pgl.config['BRANCH_QUEUE'], apply_sha)
-    if not os.path.exists(patchdir):
-        pgl.die('Missing patch directory for %s. Oops!' % (apply_name,))
+    if not args.all:
+        bases = [apply_sha]
 
-    patches = glob.glob(os.path.join(patchdir, '*.patch'))
-    if not patches:
-        pgl.die('Missing patches for %s. Oops!' % (apply_name,))
-
-    # Save our patchdir off for later use
-    patchdir_ref = os.path.join(pgl.config['QUEUES'], 'applying_dir')
-    with file(patchdir_ref, 'w') as f:
-        f.write(patchdir)
-
-    # Re-apply the patches
-    gitamargs = ['git', 'am', '--reject']
-    gitamargs.extend(patches)
-    gitam = subprocess.Popen(gitamargs, stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE)
-    check_am_and_maybe_die(gitam)
+    if args.check:
+        # Find conflicts before anything is touched, rather than halfway
+        # through git am
+        import qcheck
+        results = gitq.check_patches(bases)
+        if any(status != 'clean' for _, status, _ in results):
+            qcheck.report(results)
+            pgl.die('Not pushing, patches do not apply cleanly')
 
-    do_cleanup_and_fix_series(patchdir_ref, patchdir, apply_sha, apply_name)
+    # Replay the patches without going through the working copy. Anything
+    # that can't be replayed goes through git am, then we carry on.
+    while bases:
+        names = [pgl.config['NAMES'][base] for base in bases]
+        pushed, failed = gitq.push_patches(bases)
+        for name in names[:len(pushed)]:
+            sys.stdout.write('Applied %s\n' % (name,))
+        if failed is None:
+            break
+        am_patch(failed, pgl.config['NAMES'][failed])
+        bases = bases[len(pushed) + 1:]
 
     return 0
@@ -0,0 +1,417 @@
+#!/usr/bin/env python
+
+import argparse
+import hashlib
+import json
+import os
+import sys
+
+import gitq
+import pgl
+
+MARK_OURS = '<<<<<<< '
+MARK_SEP = '======='
+MARK_THEIRS = '>>>>>>> '
+
+def state_dir():
+    return os.path.join(pgl.config['BRANCH_QUEUE'], 'rebase')
+
+def load_state():
+    with file(os.path.join(state_dir(), 'state')) as f:
+        return json.load(f)
+
+def save_state(state):
+    gitq.atomic_write(os.path.join(state_dir(), 'state'), json.dumps(state))
+
+def clear_state():
+    import shutil
+    shutil.rmtree(state_dir())
+
+def split_conflicts(text):
+    """Split the output of merge-file into a list of ('text', lines) and
+    ('conflict', (ours, theirs)) pieces
+    """
+    pieces = []
+    cur = []
+    ours = theirs = None
+    for line in text.splitlines(True):
+        if ours is None and line.startswith(MARK_OURS):
+            pieces.append(('text', cur))
+            ours, cur = [], []
+        elif ours is not None and theirs is None and \
+             line.rstrip('\n') == MARK_SEP:
+            ours, cur = cur, []
+            theirs = cur
+        elif theirs is not None and line.startswith(MARK_THEIRS):
+            pieces.append(('conflict', (''.join(ours), ''.join(theirs))))
+            ours = theirs = None
+            cur = []
+        else:
+            cur.append(line)
+    pieces.append(('text', cur))
+    return pieces
+
+def hunk_id(ours, theirs):
+    return hashlib.sha1('%s\0%s' % (ours, theirs)).hexdigest()
+
+class Resolutions(object):
+    """Conflict resolutions we've seen for one patch, like git rerere. Each
+    conflicting hunk is identified by the text on both sides of it, so the
+    same clash comes up with the same id no matter where in the file it is
+    or what else changed upstream.
+    """
+    def __init__(self, name):
+        self.path = os.path.join(pgl.config['BRANCH_QUEUE'], 'rr-cache', name)
+
+    def resolve(self, merged):
+        """Return merged with every conflict replaced by its recorded
+        resolution, or None if there's a conflict we haven't seen
+        """
+        out = []
+        for kind, data in split_conflicts(merged):
+            if kind == 'text':
+                out.extend(data)
+                continue
+            fname = os.path.join(self.path, hunk_id(*data))
+            if not os.path.exists(fname):
+                return None
+            with file(fname) as f:
+                out.append(f.read())
+        return ''.join(out)
+
+    def record(self, preimage, postimage):
+        """Remember how the conflicts in preimage were resolved in postimage.
+        Returns the number of resolutions recorded.
+        """
+        pieces = split_conflicts(preimage)
+        lines = postimage.splitlines(True)
+        pos = 0
+        found = []
+        for i, (kind, data) in enumerate(pieces):
+            if kind == 'text':
+                if lines[pos:pos + len(data)] != data:
+                    # Changed outside the conflicts, we can't tell which bit
+                    # is the resolution
+                    return 0
+                pos += len(data)
+                continue
+            # The resolution runs up to where the following text picks up
+            after = pieces[i + 1][1]
+            end = None
+            if not after:
+                end = len(lines)
+            for j in range(pos, len(lines) - len(after) + 1):
+                if end is not None:
+                    break
+                if lines[j:j + len(after)] == after:
+                    end = j
+            if end is None:
+                return 0
+            found.append((hunk_id(*data), ''.join(lines[pos:end])))
+            pos = end
+
+        if not os.path.exists(self.path):
+            os.makedirs(self.path)
+        for hid, text in found:
+            gitq.atomic_write(os.path.join(self.path, hid), text)
+        return len(found)
+
+def read_blob(sha):
+    if sha is None:
+        return ''
+    return gitq.session().read_object(sha)[2]
+
+def merge_blobs(base, ours, theirs):
+    """Three-way merge of blob contents with git merge-file. Returns (merged
+    text, True if there were no conflicts)
+    """
+    import shutil
+    import tempfile
+
+    tmp = tempfile.mkdtemp(prefix='merge.', dir=pgl.config['QUEUES'])
+    try:
+        paths = []
+        for label, data in (('ours', ours), ('base', base), ('theirs', theirs)):
+            path = os.path.join(tmp, label)
+            with file(path, 'w') as f:
+                f.write(data)
+            paths.append(path)
+        rval, out = gitq.session().run(['merge-file', '-p', '-L', 'upstream',
+            '-L', 'base', '-L', 'patch'] + paths)
+    finally:
+        shutil.rmtree(tmp)
+    if rval < 0 or rval > 127:
+        pgl.die('git merge-file failed')
+    return out, rval == 0
+
+def merge_commit(env, cur, commit, name):
+    """Merge the changes commit makes into cur file by file, for when the
+    patch doesn't apply as-is. Returns (tree, {path: merged text or None}
+    for paths that still conflict). Conflicted paths keep cur's version in
+    the tree.
+    """
+    gs = gitq.session()
+    info = gs.commit_info(commit)
+    parent = info['parents'][0]
+    cur_tree = gs.rev_parse('%s^{tree}' % (cur,))
+    if gs.run(['read-tree', cur_tree], env=env)[0]:
+        pgl.die('Failed to read tree %s' % (cur_tree,))
+
+    rval, out = gs.run(['diff-tree', '-r', '-z', '--no-renames', parent,
+                        commit])
+    if rval:
+        pgl.die('Failed to diff %s' % (commit,))
+    fields = out.split('\0')
+    rr = Resolutions(name)
+    updates = []
+    conflicts = {}
+    for i in range(0, len(fields) - 1, 2):
+        omode, nmode, osha, nsha, status = fields[i].lstrip(':').split()
+        path = fields[i + 1]
+        base = None if status == 'A' else osha
+        theirs = None if status == 'D' else nsha
+        found = gs.object_info('%s:%s' % (cur_tree, path))
+        ours = found[0] if found else None
+
+        if ours == base:
+            if theirs is None:
+                updates.append('0 %s\t%s\n' % ('0' * 40, path))
+            else:
+                updates.append('%s %s\t%s\n' % (nmode, theirs, path))
+            continue
+        if ours == theirs:
+            continue
+        if ours is None or theirs is None:
+            # Deleted on one side, changed on the other
+            conflicts[path] = None
+            continue
+
+        merged, clean = merge_blobs(read_blob(base), read_blob(ours),
+                                    read_blob(theirs))
+        if not clean:
+            resolved = rr.resolve(merged)
+            if resolved is None:
+                conflicts[path] = merged
+                continue
+            sys.stdout.write('Resolved %s using previous resolution\n' %
+                (path,))
+            merged = resolved
+        rval, sha = gs.run(['hash-object', '-w', '--stdin'], input=merged)
+        if rval:
+            pgl.die('Failed to write %s' % (path,))
+        updates.append('%s %s\t%s\n' % (nmode, sha.strip(), path))
+
+    if updates and gs.run(['update-index', '-z', '--index-info'], env=env,
+            input=''.join(u[:-1] + '\0' for u in updates))[0]:
+        pgl.die('Failed to update index')
+    rval, tree = gs.run(['write-tree'], env=env)
+    if rval:
+        pgl.die('Failed to write tree')
+    return tree.strip(), conflicts
+
+def owners():
+    """Map every commit in the applied series to the name of its patch
+    """
+    owned = {}
+    for base in pgl.config['SERIES']:
+        name = pgl.config['NAMES'][base]
+        for c in gitq.patch_commits(base, gitq.patch_tip(base)):
+            owned[c] = name
+    return owned
+
+def stop(state, cur, commit, tree, conflicts):
+    """Leave a conflict in the working copy for the user to sort out
+    """
+    gs = gitq.session()
+    if not gitq.move_head(cur):
+        pgl.die('Failed to update working copy')
+    if gs.call(['read-tree', '-m', '-u', 'HEAD', tree]):
+        pgl.die('Failed to update working copy')
+
+    pre = os.path.join(state_dir(), 'preimage')
+    if not os.path.exists(pre):
+        os.makedirs(pre)
+    info = gs.commit_info(commit)
+    work = os.path.dirname(pgl.config['GIT_DIR'])
+    state['conflicts'] = {}
+    for i, (path, merged) in enumerate(sorted(conflicts.iteritems())):
+        if merged is None:
+            sys.stdout.write('CONFLICT (modify/delete): %s\n' % (path,))
+            state['conflicts'][path] = None
+            theirs = gs.object_info('%s:%s' % (commit, path))
+            if theirs is not None:
+                with file(os.path.join(work, path), 'w') as f:
+                    f.write(read_blob(theirs[0]))
+            continue
+        sys.stdout.write('CONFLICT (content): %s\n' % (path,))
+        with file(os.path.join(work, path), 'w') as f:
+            f.write(merged)
+        preimage = os.path.join(pre, str(i))
+        with file(preimage, 'w') as f:
+            f.write(merged)
+        state['conflicts'][path] = preimage
+
+    state['stopped'] = commit
+    save_state(state)
+    sys.stdout.write('Patch %s failed at: %s\n' %
+        (state['owners'][commit], info['message'].split('\n', 1)[0]))
+    sys.stdout.write('When you have resolved this problem run "git qrebase --continue"\n')
+    sys.stdout.write('To restore the original branch and stop rebasing run "git qrebase --abort"\n')
+    sys.exit(1)
+
+def run(state):
+    """Replay whatever's left to do, stopping at the first real conflict
+    """
+    gs = gitq.session()
+    env = gitq.temp_index('rebase')
+    cur = state['cur']
+    todo = state['todo']
+    while todo:
+        cur, mapping, conflict = gitq.replay(todo, cur, env=env)
+        state['mapping'].update(mapping)
+        if conflict is None:
+            todo = []
+            break
+        todo = todo[todo.index(conflict) + 1:]
+        tree, conflicts = merge_commit(env, cur, conflict,
+                                       state['owners'][conflict])
+        if conflicts:
+            state['cur'] = cur
+            state['todo'] = todo
+            stop(state, cur, conflict, tree, conflicts)
+        info = gs.commit_info(conflict)
+        cur = gitq.commit_tree(tree, [cur], info['author'], info['message'])
+        state['mapping'][conflict] = cur
+    state['cur'] = cur
+    finish(state)
+
+def finish(state):
+    """Move HEAD to the rebased series and record the new patch bases
+    """
+    cur = state['cur']
+    if cur != pgl.config['HEAD_SHA'] and not gitq.move_head(cur):
+        pgl.die('Failed to update working copy')
+
+    series = pgl.config['SERIES']
+    rebased = []
+    for i, base in enumerate(series):
+        newbase = state['mapping'][base]
+        series[i] = newbase
+        gitq.rename_patch_base(base, newbase)
+        rebased.append(newbase)
+    pgl.config['ACTIVE_PATCH'] = series[-1]
+    gitq.write_series()
+    gitq.update_patch_cache(rebased)
+
+    if os.path.exists(state_dir()):
+        clear_state()
+    sys.stdout.write('Rebased %d patches onto %s\n' %
+        (len(series), state['upstream']))
+
+def resume(state):
+    """Commit the user's resolution of a stopped rebase and carry on
+    """
+    gs = gitq.session()
+    work = os.path.dirname(pgl.config['GIT_DIR'])
+    paths = sorted(state['conflicts'])
+    for path in paths:
+        full = os.path.join(work, path)
+        if not os.path.exists(full):
+            continue
+        with file(full) as f:
+            for line in f:
+                if line.startswith(MARK_OURS) or line.startswith(MARK_THEIRS):
+                    pgl.die('%s still has conflict markers' % (path,))
+
+    if gs.call(['add', '-A', '--'] + paths):
+        pgl.die('Failed to add resolved files')
+    rval, tree = gs.run(['write-tree'])
+    if rval:
+        pgl.die('Failed to write tree')
+
+    commit = state['stopped']
+    rr = Resolutions(state['owners'][commit])
+    for path, preimage in state['conflicts'].iteritems():
+        full = os.path.join(work, path)
+        if preimage is None or not os.path.exists(full):
+            continue
+        with file(preimage) as f:
+            pre = f.read()
+        with file(full) as f:
+            post = f.read()
+        if rr.record(pre, post):
+            sys.stdout.write('Recorded resolution for %s\n' % (path,))
+
+    info = gs.commit_info(commit)
+    cur = gitq.commit_tree(tree.strip(), [state['cur']], info['author'],
+                           info['message'])
+    if gs.run(['update-ref', '-m', 'qrebase', 'HEAD', cur,
+               pgl.config['HEAD_SHA']])[0]:
+        pgl.die('Failed to update HEAD')
+    pgl.config['HEAD_SHA'] = cur
+    state['mapping'][commit] = cur
+    state['cur'] = cur
+    state['stopped'] = None
+    state['conflicts'] = {}
+    run(state)
+
+@pgl.main
+def main():
+    ap = argparse.ArgumentParser(
+        description='Move the applied patches onto a new upstream',
+        prog='git qrebase')
+    ap.add_argument('upstream', help='Commit to rebase onto', default=None,
+        nargs='?')
+    ap.add_argument('--continue', dest='resume',
+        help='Continue paused qrebase', default=False, action='store_true')
+    ap.add_argument('--abort', dest='abort', help='Abort paused qrebase',
+        default=False, action='store_true')
+    args = gitq.parse_args(ap)
+
+    gitq.include_config()
+    gitq.lock_queue(exclusive=True)
+    if not gitq.queue_exists():
+        pgl.die('There is no git queue for branch %s here!' %
+            (pgl.config['BRANCH'],))
+    gitq.load_series()
+    gs = gitq.session()
+
+    if args.abort or args.resume:
+        if not os.path.exists(state_dir()):
+            pgl.die('No qrebase in progress')
+        state = load_state()
+        if args.abort:
+            gs.call(['reset', '-q', '--hard', state['orig_head']])
+            clear_state()
+            return 0
+        resume(state)
+        return 0
+
+    if os.path.exists(state_dir()):
+        pgl.die('A qrebase is already in progress. Use --continue or --abort.')
+    if not args.upstream:
+        pgl.die('Where should the patches go?')
+    if not pgl.config['SERIES']:
+        pgl.die('No patches applied!')
+
+    onto = gs.rev_parse('%s^{commit}' % (args.upstream,))
+    if onto is None:
+        pgl.die('Unknown revision: %s' % (args.upstream,))
+    if gs.rev_parse('%s~1' % (pgl.config['SERIES'][0],)) == onto:
+        sys.stdout.write('Already based on %s\n' % (args.upstream,))
+        return 0
+
+    if gitq.repo_has_changes(untracked=False):
+        pgl.die('Working copy has uncommitted changes. Either qrefresh or '
+                'stash them before continuing.')
+
+    owned = owners()
+    todo = gs.lines(['rev-list', '--reverse', '%s~1..%s' %
+                     (pgl.config['SERIES'][0], pgl.config['HEAD_SHA'])])
+    os.mkdir(state_dir())
+    state = {'orig_head': pgl.config['HEAD_SHA'], 'upstream': args.upstream,
+             'cur': onto, 'todo': todo, 'owners': owned, 'mapping': {},
+             'stopped': None, 'conflicts': {}}
+    run(state)
+
+    return 0
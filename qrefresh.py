@@ -1,28 +1,98 @@
 #!/usr/bin/env python
 
 import argparse
-import os
 
 import gitq
 import pgl
 
+def refresh_from_diff(args):
+    """Update the patch with a diff instead of the working copy, all in the
+    object database, so it works without a checkout
+    """
+    if not pgl.config['SERIES']:
+        pgl.die('No patches applied!')
+    head = pgl.config['HEAD_SHA']
+    tree = gitq.diff_to_tree(gitq.read_diff(args.fromdiff), head)
+    if tree is None:
+        pgl.die('The diff does not apply to %s' % (pgl.config['BRANCH'],))
+    if tree == gitq.session().rev_parse('%s^{tree}' % (head,)):
+        pgl.die('There was nothing to update the patch with!')
+
+    if args.amend:
+        base = pgl.config['ACTIVE_PATCH']
+        if args.pname:
+            base = pgl.config['SHAS'].get(args.pname)
+            if base not in pgl.config['SERIES']:
+                pgl.die('%s is not an applied patch' % (args.pname,))
+        if not gitq.amend_patch(base, newtree=tree):
+            pgl.die('Changes do not apply cleanly to %s' %
+                (pgl.config['NAMES'][base],))
+        return 0
+
+    active = pgl.config['ACTIVE_PATCH']
+    tip = gitq.commit_tree(tree, [head], gitq.own_ident(),
+        'fixup! %s\n' % (gitq.patch_subject(active),))
+    if not gitq.set_branch_tip(tip, 'gitq: refresh'):
+        pgl.die('Failed to update %s' % (pgl.config['BRANCH'],))
+    gitq.update_patch_cache([active])
+
+    return 0
+
 @pgl.main
 def main():
     ap = argparse.ArgumentParser(description='Update a patch',
         prog='git qrefresh')
     ap.add_argument('-a', dest='all', help='Add all unstaged changes to patch',
         action='store_true', default=False)
-    args = ap.parse_args()
+    ap.add_argument('--amend', dest='amend',
+        help='Fold changes into the patch instead of adding a fixup commit',
+        action='store_true', default=False)
+    ap.add_argument('-p', dest='pname', default=None,
+        help='Patch to fold changes into with --amend (default: the top one)')
+    ap.add_argument('--from-diff', dest='fromdiff', metavar='FILE',
+        default=None,
+        help='Update the patch with a diff (- for stdin) without touching the '
+             'working copy')
+    args = gitq.parse_args(ap)
 
-    gitq.include_config()
+    if args.fromdiff and args.all:
+        pgl.die('-a and --from-diff do not go together')
 
-    gitq.load_series()
+    gitq.include_config()
+    gitq.lock_queue(exclusive=True)
 
-    if not os.path.exists(pgl.config['QUEUE_SERIES']):
+    if not gitq.queue_exists():
         pgl.die('There is no git queue for branch %s here!' %
             (pgl.config['BRANCH'],))
 
+    gitq.load_series()
+
+    if args.pname and not args.amend:
+        pgl.die('-p only works with --amend')
+
+    if args.fromdiff:
+        return refresh_from_diff(args)
+
+    if args.amend:
+        if not pgl.config['SERIES']:
+            pgl.die('No patches applied!')
+        base = pgl.config['ACTIVE_PATCH']
+        if args.pname:
+            base = pgl.config['SHAS'].get(args.pname)
+            if base not in pgl.config['SERIES']:
+                pgl.die('%s is not an applied patch' % (args.pname,))
+        if not gitq.repo_has_changes(untracked=False, worktree=args.all):
+            pgl.die('There was nothing to update the patch with!')
+        if not gitq.amend_patch(base, commit_all=args.all):
+            pgl.die('Changes do not apply cleanly to %s' %
+                (pgl.config['NAMES'][base],))
+        return 0
+
     if not gitq.update_patch(commit_all=args.all):
         pgl.die('There was nothing to update the patch with!')
 
+    # The tip moved, so the cached summary of the patch is out of date
+    gitq.include_config()
+    gitq.update_patch_cache([pgl.config['ACTIVE_PATCH']])
+
     return 0
@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+
+import argparse
+import os
+import sys
+
+import gitq
+import pgl
+
+def load(local=False):
+    """Return the queue state, from the daemon if there is one (unless we
+    need the queue loaded here anyway)
+    """
+    # The daemon only knows about the checked-out branch, and there's no
+    # point loading the code to talk to it unless it's running
+    if not local and not os.environ.get('GITQ_BRANCH') and \
+       'GIT_DIR' in pgl.config and \
+       os.path.exists(os.path.join(pgl.config['GIT_DIR'], 'queue',
+                                   'daemon.sock')):
+        import qdaemon
+        data = qdaemon.request({'op': 'series'})
+        if data is not None and 'error' not in data:
+            return data
+
+    gitq.include_config()
+    gitq.lock_queue()
+    data = {'branch': pgl.config['BRANCH'], 'applied': [], 'unapplied': [],
+            'active': None}
+    if not gitq.queue_exists():
+        return data
+    gitq.load_series()
+    names = pgl.config['NAMES']
+    data['applied'] = [names[sha] for sha in pgl.config['SERIES']]
+    data['unapplied'] = [names[sha] for sha in reversed(pgl.config['UNAPPLIED'])]
+    if pgl.config['ACTIVE_PATCH']:
+        data['active'] = names[pgl.config['ACTIVE_PATCH']]
+    return data
+
+@pgl.main
+def main():
+    ap = argparse.ArgumentParser(description='List the patches in the queue',
+        prog='git qseries')
+    ap.add_argument('-v', dest='verbose', help='Show applied/unapplied status',
+        default=False, action='store_true')
+    ap.add_argument('-s', '--summary', dest='summary',
+        help='Show the subject of each patch', default=False,
+        action='store_true')
+    ap.add_argument('--stat', dest='stat',
+        help='Show how many files and lines each patch changes',
+        default=False, action='store_true')
+    ap.add_argument('--active', dest='active', help='Only show the top patch',
+        default=False, action='store_true')
+    args = gitq.parse_args(ap)
+
+    # Summaries come out of the patch cache, which needs the queue here
+    data = load(local=args.summary or args.stat)
+
+    if args.active:
+        if not data['active']:
+            return 1
+        sys.stdout.write('%s\n' % (data['active'],))
+        return 0
+
+    # Applied patches bottom to top, then parked ones in the order qpush
+    # would apply them
+    i = 0
+    for status, key in (('A', 'applied'), ('U', 'unapplied')):
+        for name in data[key]:
+            line = name
+            if args.verbose:
+                line = '%d %s %s' % (i, status, name)
+            if args.summary or args.stat:
+                info = gitq.patch_info(pgl.config['SHAS'][name])
+                if info is not None and args.stat:
+                    line += ' (%d files, +%d -%d)' % tuple(info['diffstat'])
+                if info is not None and args.summary:
+                    line += ': %s' % (info['subject'],)
+            sys.stdout.write('%s\n' % (line,))
+            i += 1
+
+    if args.summary or args.stat:
+        gitq.patch_cache().save(set(pgl.config['NAMES'].itervalues()))
+
+    return 0
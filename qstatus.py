@@ -0,0 +1,155 @@
+#!/usr/bin/env python
+
+import argparse
+import os
+import sys
+
+import gitq
+import pgl
+
+def queue_size(qdir):
+    """Bytes used by a queue's metadata and saved patches on disk
+    """
+    total = 0
+    for root, _, files in os.walk(qdir):
+        for f in files:
+            try:
+                total += os.path.getsize(os.path.join(root, f))
+            except OSError:
+                pass
+    return total
+
+def human(size):
+    for unit in ('', 'K', 'M', 'G'):
+        if size < 1024 or unit == 'G':
+            break
+        size /= 1024.0
+    if not unit:
+        return '%d' % (size,)
+    return '%.1f%s' % (size, unit)
+
+def queue_status(qdir):
+    """Work out the state of the queue in qdir without checking its branch
+    out. Returns a dict, or None if qdir isn't a queue.
+    """
+    lock = gitq.QueueLock(qdir)
+    lock.acquire()
+    try:
+        return _queue_status(qdir)
+    finally:
+        lock.release()
+
+def _queue_status(qdir):
+    gs = gitq.session()
+    store = gitq.QueueStore(qdir)
+    if not store.exists():
+        return None
+    state = store.state
+    sanitized = os.path.basename(qdir)
+    branch = store.branch
+    if qdir == pgl.config['BRANCH_QUEUE']:
+        branch = pgl.config['BRANCH']
+    tip = None
+    if branch is not None:
+        tip = gs.rev_parse('refs/heads/%s' % (branch,))
+
+    series = state['series']
+    stale = []
+    if branch is None:
+        # Made by an older gitq that didn't record its branch, so there's
+        # nothing to check the series against
+        pass
+    elif tip is None:
+        stale = list(series)
+    elif series:
+        # Everything applied should sit between the branch tip and the
+        # commit below the first patch, so one rev-list answers for all
+        args = ['rev-list', tip]
+        bottom = gs.rev_parse('%s~1' % (series[0],))
+        if bottom is not None:
+            args += ['--not', bottom]
+        reachable = set(gs.lines(args) or [])
+        stale = [base for base in series if base not in reachable]
+
+    missing = []
+    pack = gitq.PatchPack(qdir)
+    for base in state['unapplied']:
+        ref = gitq.parked_ref(sanitized, state['names'].get(base, ''))
+        if gs.rev_parse(ref) is None and \
+           not os.path.isdir(os.path.join(qdir, base)) and \
+           base not in pack:
+            missing.append(base)
+
+    return {'branch': branch or sanitized, 'known': branch is not None,
+            'exists': tip is not None,
+            'applied': len(series), 'unapplied': len(state['unapplied']),
+            'stale': [state['names'].get(b, b) for b in stale],
+            'missing': [state['names'].get(b, b) for b in missing],
+            'size': queue_size(qdir)}
+
+@pgl.main
+def main():
+    ap = argparse.ArgumentParser(description='Show the state of patch queues',
+        prog='git qstatus')
+    ap.add_argument('-a', '--all', dest='all', default=False,
+        action='store_true', help='Show the queue of every branch')
+    ap.add_argument('-v', dest='verbose', default=False, action='store_true',
+        help='Name the stale and missing patches')
+    ap.add_argument('-j', dest='jobs', type=int, default=None,
+        help='Queues to look at at once')
+    args = gitq.parse_args(ap)
+
+    gitq.include_config()
+    gs = gitq.session()
+
+    if args.all:
+        qdirs = []
+        if os.path.exists(pgl.config['QUEUES']):
+            qdirs = [os.path.join(pgl.config['QUEUES'], d)
+                     for d in sorted(os.listdir(pgl.config['QUEUES']))]
+        qdirs = [d for d in qdirs if os.path.isdir(d)]
+    else:
+        if not gitq.queue_exists():
+            pgl.die('There is no git queue for branch %s here!' %
+                (pgl.config['BRANCH'],))
+        qdirs = [pgl.config['BRANCH_QUEUE']]
+
+    # Get cat-file going before there are threads around to leak pipes into
+    # it, then look at every queue at once
+    gs.rev_parse('HEAD')
+    if len(qdirs) > 1:
+        import multiprocessing
+        from multiprocessing.pool import ThreadPool
+        pool = ThreadPool(min(args.jobs or multiprocessing.cpu_count() * 2,
+                              len(qdirs)))
+        try:
+            results = pool.map(queue_status, qdirs)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = [queue_status(d) for d in qdirs]
+    results = [r for r in results if r is not None]
+
+    if not results:
+        pgl.die('No queues here!')
+
+    sys.stdout.write('  %-30s %7s %9s %5s %7s\n' %
+        ('branch', 'applied', 'unapplied', 'stale', 'size'))
+    for r in results:
+        current = '*' if r['branch'] == pgl.config['BRANCH'] else ' '
+        branch = r['branch']
+        if not r['known']:
+            branch = '%s (branch unknown)' % (branch,)
+        elif not r['exists']:
+            branch = '%s (gone)' % (branch,)
+        sys.stdout.write('%s %-30s %7d %9d %5d %7s\n' % (current, branch,
+            r['applied'], r['unapplied'], len(r['stale']) + len(r['missing']),
+            human(r['size'])))
+        if args.verbose:
+            for name in r['stale']:
+                sys.stdout.write('    stale base: %s\n' % (name,))
+            for name in r['missing']:
+                sys.stdout.write('    missing: %s\n' % (name,))
+
+    return 0
@@ -1,5 +1,8 @@
 from distutils.core import setup
-setup(name='gitq-lib', version='0.1', py_modules=['gitq'],
+setup(name='gitq-lib', version='0.1',
+    py_modules=['gitq', 'qcheck', 'qcommit', 'qdaemon', 'qdiff', 'qgoto',
+                'qgraph', 'qimport', 'qnew', 'qpack', 'qpatch', 'qpop', 'qpush',
+                'qrebase', 'qrefresh', 'qseries', 'qstatus'],
     description='Library for use by gitq', author='Nick Hurley',
     author_email='hurley@todesschaf.org',
     url='https://github.com/todesschaf/gitq')